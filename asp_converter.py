@@ -1,18 +1,41 @@
 from semantic_extraction import Modifier, Property, Event
 from spacy import symbols
 import spacy
-from operator import itemgetter
-import jsonlines
 import random
 import queue
-import time
-import json
 from collections import Counter
 import os
-import signal
-from subprocess import Popen, PIPE, TimeoutExpired
+import tempfile
+from record_store import RecordStore
+from ilasp_scheduler import IlaspScheduler, IlaspCancelled, task_size
+import profiling
+from conceptnet_store import ConceptNetStore, LandmarkIndex, POS_MODEL
+import numpy as np
 
-model = spacy.load('en_core_web_sm')
+# Only needed for words the conceptnet store has no POS tag for, so loaded on first use.
+pos_model = None
+
+def get_pos_model():
+    global pos_model
+    if pos_model is None:
+        pos_model = spacy.load(POS_MODEL, disable=['parser', 'ner'])
+    return pos_model
+
+# The rules resolving the pronoun to anything sharing a property or an event
+# with it. These are part of every program, and are kept as the shared base
+# program when solving with AspRunner in multi-shot mode.
+def coref_rules(pronoun_symbol):
+    return [
+        f'coref({pronoun_symbol}, Y) :- property(P, {pronoun_symbol}), property(P, Y), Y != {pronoun_symbol}.',
+        f'coref({pronoun_symbol}, Y) :- event_subject(E, {pronoun_symbol}), event_subject(E, Y), Y != {pronoun_symbol}.',
+        f'coref({pronoun_symbol}, Y) :- event_object(E, {pronoun_symbol}), event_object(E, Y), Y != {pronoun_symbol}.',
+    ]
+
+# Prefer tmpfs for short-lived files passed between processes.
+def default_workspace():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
 """
 Build a commonsense program using ILASP to generate knowledge.
@@ -21,10 +44,18 @@ class IlaspBuilder:
     """
     pronoun_symbol (string): The string used to represent the target to be resolved.
     debug (boolean): If true will save debug info to files.
+    cache_dir (string): Directory to persist ILASP results in. Results are only kept in memory if None.
+    workspace (string): Directory for the temporary ILASP task files. Defaults to tmpfs when available.
+    scheduler (IlaspScheduler): Runs the ILASP tasks. By default, each is given 200 seconds.
     """
-    def __init__(self, pronoun_symbol, debug=False):
+    def __init__(self, pronoun_symbol, debug=False, cache_dir=None, workspace=None, scheduler=None):
         self.pronoun_symbol = pronoun_symbol
+        self.scheduler = scheduler or IlaspScheduler()
         self.debug = debug
+        self.workspace = workspace or default_workspace()
+        # Learnt hypotheses (or timeouts/UNSATISFIABLE), keyed by the learning task.
+        results_filename = os.path.join(cache_dir, 'ilasp.bin') if cache_dir else None
+        self.results = RecordStore(results_filename)
 
     # Format a positive or negative training example with the given
     # information.
@@ -37,15 +68,12 @@ class IlaspBuilder:
         return f'#neg(n{id}, {inc}, {exc}, {context}).'
 
     # Convert the examples into an inductive learning task.
-    def build_ilasp_program(self, examples):
+    def build_ilasp_program(self, examples, debug_dir='.'):
         body_bias = []
         positive_examples = []
         negative_examples = []
         head_bias = []
-        background = []
-        background.append(f'coref({self.pronoun_symbol}, Y) :- property(P, {self.pronoun_symbol}), property(P, Y), Y != {self.pronoun_symbol}.')
-        background.append(f'coref({self.pronoun_symbol}, Y) :- event_subject(E, {self.pronoun_symbol}), event_subject(E, Y), Y != {self.pronoun_symbol}.')
-        background.append(f'coref({self.pronoun_symbol}, Y) :- event_object(E, {self.pronoun_symbol}), event_object(E, Y), Y != {self.pronoun_symbol}.')
+        background = coref_rules(self.pronoun_symbol)
         body_bias.append('#bias("no_constraint.").')
         # Count how often each predicate occurs. This will be used to determine
         # how many times a predicate should occur in a rule body.
@@ -62,69 +90,100 @@ class IlaspBuilder:
                     head_bias.append(f'#modeh({p.ungrounded(arg_to_var)}).')
             predicate_counts = predicate_counts | counts_for_example
             # Background context is just all predicates, plus type information.
-            ctx = ' '.join(list(set([p.grounded() for p in predicates]))) + ' ' + ' '.join(list(set(entities)))
+            # Sorted so that the same examples always give the same task.
+            ctx = ' '.join(sorted(set([p.grounded() for p in predicates]))) + ' ' + ' '.join(sorted(set(entities)))
             correct_candidate = '_'.join(example.get_correct_candidate().split(' '))
             incorrect_candidate = '_'.join(example.get_incorrect_candidate().split(' '))
             positive_examples.append(self.create_example(True, i, f'coref({self.pronoun_symbol}, {correct_candidate})', ctx))
             negative_examples.append(self.create_example(False, i, f'coref({self.pronoun_symbol}, {incorrect_candidate})', ctx))
         for p in predicate_counts:
             body_bias.append(f'#modeb({predicate_counts[p]}, {p}, (anti_reflexive)).')
-        program = '\n'.join(background + list(set(head_bias)) + list(set(body_bias)) + positive_examples + negative_examples)
+        program = '\n'.join(background + sorted(set(head_bias)) + sorted(set(body_bias)) + positive_examples + negative_examples)
         if self.debug:
-            with open('ilasp-translation.lp', 'w') as f:
+            with open(os.path.join(debug_dir, 'ilasp-translation.lp'), 'w') as f:
                 f.write(program)
         return program
 
     def encode_problem(self, predicates):
         return '\n'.join([p.grounded() for p in predicates])
 
-    # Attempt to run the command, but abort if timeout seconds pass.
-    def run_with_timeout(self, command, timeout):
-        with Popen(command, stdout=PIPE, preexec_fn=os.setsid) as process:
-            try:
-                output = process.communicate(timeout=timeout)[0].decode('utf-8')
-            except TimeoutExpired:
-                os.killpg(process.pid, signal.SIGINT) # send signal to the process group
-                output = '' # process.communicate()[0]
-        return output
+    # Run ILASP on the learning task, reusing the result of an earlier run on
+    # the same task. A cached timeout is only reused if it had at least as
+    # much time as the scheduler would give it now.
+    def learn(self, program, cancel=None):
+        ilasp_options = ['--clingo5', '--clingo', "lib/clingo", '-q', '--version=2i']
+        key = RecordStore.key(' '.join(ilasp_options), program)
+        size = task_size(program)
+        timeout = self.scheduler.timeout_for(size)
+        cached = self.results.get(key)
+        if cached is not None and (cached['status'] != 'timeout' or cached['timeout'] >= timeout):
+            profiling.count('ilasp.cached')
+            profiling.count(f'ilasp.{cached["status"]}')
+            return cached['output']
+        if cancel is not None and cancel.is_set():
+            raise IlaspCancelled()
+        # Each run gets its own task file, so concurrent solves don't interfere.
+        with tempfile.NamedTemporaryFile('w', prefix='ilasp-', suffix='.lp', dir=self.workspace, delete=False) as f:
+            f.write(program)
+            filename = f.name
+        try:
+            ilasp_command = ['lib/ILASP'] + ilasp_options + [f'{filename}']
+            with profiling.span('ilasp'):
+                job = self.scheduler.run(ilasp_command, size, name=key.hex(), timeout=timeout, cancel=cancel)
+        except IlaspCancelled:
+            profiling.count('ilasp.cancelled')
+            raise
+        finally:
+            os.remove(filename)
+        profiling.count(f'ilasp.{job.status}')
+        if job.status in ['ok', 'unsat']:
+            self.results.put(key, {'status': job.status, 'output': job.output, 'timeout': job.timeout})
+        elif job.status in ['timeout', 'budget', 'cpu_limit'] and job.timeout > 0:
+            # ILASP didn't finish in the time it ran for, which a later run
+            # with no more time than that can reuse.
+            self.results.put(key, {'status': 'timeout', 'output': '', 'timeout': min(job.timeout, job.seconds)})
+        return job.output
 
     # Build the full program
-    def build(self, examples, unused_test_details, test):
-        timeout = 200
-        program = self.build_ilasp_program(examples)
+    # debug_dir (string): Where debug files for this build are written.
+    # cancel (threading.Event): If set while ILASP is running, the build is aborted.
+    def build(self, examples, unused_test_details, test, debug_dir='.', cancel=None):
+        program = self.build_ilasp_program(examples, debug_dir=debug_dir)
         problem_facts = self.encode_problem(test)
-        filename = 'tmp-ilasp-translation.lp'
-        ilasp_command = ['lib/ILASP', '--clingo5', '--clingo', "lib/clingo", '-q', '--version=2i', f'{filename}']
-        with open(filename, 'w') as f:
-            f.write(program)
         # run with subprocess, build entities again, add ilasp program and facts from test
-        output = self.run_with_timeout(ilasp_command, timeout)
-        # Program is treated as empty if it was UNSATISFIABLE.
-        if 'UNSATISFIABLE' in output:
-            output = ''
-        background = []
-        background.append(f'coref({self.pronoun_symbol}, Y) :- property(P, {self.pronoun_symbol}), property(P, Y), Y != {self.pronoun_symbol}.')
-        background.append(f'coref({self.pronoun_symbol}, Y) :- event_subject(E, {self.pronoun_symbol}), event_subject(E, Y), Y != {self.pronoun_symbol}.')
-        background.append(f'coref({self.pronoun_symbol}, Y) :- event_object(E, {self.pronoun_symbol}), event_object(E, Y), Y != {self.pronoun_symbol}.')
+        output = self.learn(program, cancel)
+        background = coref_rules(self.pronoun_symbol)
         if self.debug:
-            with open('ilasp-learnt-program.lp', 'w') as f:
+            with open(os.path.join(debug_dir, 'ilasp-learnt-program.lp'), 'w') as f:
                 f.write(output)
-            with open('ilasp-full-program.lp', 'w') as f:
+            with open(os.path.join(debug_dir, 'ilasp-full-program.lp'), 'w') as f:
                 f.write('\n'.join(background) + problem_facts + '\n' + output)
-        os.remove(filename)
         return '\n'.join(background) + '\n' + problem_facts + '\n' + output
 
 # Build a commonsense program using conceptnet to generate knowledge.
 class ConceptNetTranslation:
-    def __init__(self, pronoun_symbol, debug=False):
+    """
+    pronoun_symbol (string): The string used to represent the target to be resolved.
+    debug (boolean): If true will save debug info to files.
+    max_depth (int): The longest path searched for between two words. Unbounded if None.
+    max_expansions (int): The max number of nodes expanded by one path search. Unbounded if None.
+    cache_dir (string): Directory to persist the rules found for each pair of words in. Rules are only kept in memory if None.
+    cache_size (int): The max number of word pairs whose rules are kept in memory.
+    """
+    def __init__(self, pronoun_symbol, debug=False, max_depth=None, max_expansions=None, cache_dir=None, cache_size=65536):
         self.pronoun_symbol = pronoun_symbol
         self.debug = debug
-        self.db_file = []
-        with jsonlines.open('conceptnet/db.jsonl', 'r') as f:
-            for line in f:
-                self.db_file.append(line)
-        with open('conceptnet/node_locations.json', 'r') as f:
-            self.node_locations = json.load(f)
+        self.max_depth = max_depth
+        self.max_expansions = max_expansions
+        # Built from conceptnet/db.jsonl on first use.
+        self.store = ConceptNetStore.open()
+        # Optional, built by conceptnet/get_depth.py.
+        self.landmarks = LandmarkIndex.open(self.store)
+        # The path and rules for each (start, end) pair. The file is specific to
+        # this build of the store, so rebuilding the store starts a new cache.
+        rules_filename = os.path.join(cache_dir, f'conceptnet-rules-{self.store.build_id}.bin') if cache_dir else None
+        self.rule_cache = RecordStore(rules_filename, maxsize=cache_size)
+        self.rules_version = self.store.meta['pos_model'] or POS_MODEL
 
     # get all predicates containing starting word
     def get_relevant_predicates(self, predicates, starting_phrases, seen):
@@ -138,61 +197,95 @@ class ConceptNetTranslation:
                 link_words += [word for word in all_args if word not in seen]
         return set(link_words)
 
-    def find_path_if_it_exists(self, start, goal):
-        if start == goal:
-            return None
-        if not self._find_node_if_present(start) and not self._find_node_if_present(goal):
-            return None
-        return self._bfs(start, goal, set(), [], 0)
-
-    def _bfs(self, current, goal, visited, path, depth):
-        waiting = []
-        waiting.append((current, [], 0))
-        paths = []
-        while waiting:
-            (curr, path, depth) = waiting.pop(0)
-            if curr in visited: continue
-            visited.add(curr)
-            a = time.perf_counter()
-            next = self._find_node_if_present(curr)
-            b = time.perf_counter()
-            if next is None: continue
-            for edge in next:
-                next_word, relation = itemgetter('name', 'relation')(edge)
-                if next_word in visited: continue
-                if next_word == goal:
-                    return path + [(curr, relation, next_word)]
-                waiting.append((next_word, path + [(curr, relation, next_word)], depth + 1))
-        if paths:
-            return paths[0]
-        return None
-
-    def _dfs(self, current, goal, visited, path, depth):
-        if depth > 15:
-            return None
-        visited.add(current)
-        if current == goal: return path
-        a = time.perf_counter()
-        next = self._find_node_if_present(current)
-        b = time.perf_counter()
-        if next is None: return None
-        for edge in next:
-            next_word, relation = itemgetter('name', 'relation')(edge)
-            if next_word in visited: continue
-            full_path = self._dfs(next_word, goal, visited, path + [(current, relation, next_word)], depth + 1)
-            if full_path is not None: return full_path
-        return None
-
-    def _find_node_if_present(self, name):
-        if not name in self.node_locations:
-            return None
-        l = self.node_locations[name]
-        return self.db_file[l][name]
+    # False if the landmark index shows there is no path (within max_depth) from start to goal.
+    def _may_reach(self, start, goal):
+        if self.landmarks is None:
+            return True
+        if not self.landmarks.reachable(start, goal):
+            return False
+        return self.max_depth is None or self.landmarks.lower_bounds([start], goal)[0] <= self.max_depth
+
+    """
+    Find a shortest path from start to each of the goals with one breadth first
+    search, instead of a search per goal. Returns a dict from each goal that
+    was reached to its path. Paths are the ones a separate forward search from
+    start would return, so the rules built from them are the same.
+    """
+    def find_paths(self, start, goals):
+        start_id = self.store.node_id(start)
+        if start_id is None:
+            return {}
+        targets = {}
+        for goal in goals:
+            if goal == start:
+                continue
+            goal_id = self.store.node_id(goal)
+            if goal_id is None:
+                continue
+            if not self.store.has_edges(start_id) and not self.store.has_edges(goal_id):
+                continue
+            if not self._may_reach(start_id, goal_id):
+                continue
+            targets[goal_id] = goal
+        if not targets:
+            return {}
+        parents = self._multi_target_bfs(start_id, set(targets))
+        return {
+            goal: self._path_to(goal_id, parents)
+            for goal_id, goal in targets.items() if goal_id in parents}
+
+    # Breadth first search from start until every target has been reached.
+    # Returns the parent pointers (node -> (previous node, relation)).
+    def _multi_target_bfs(self, start, targets):
+        parents = {start: None}
+        frontier = [start]
+        remaining = set(targets)
+        depth = 0
+        expansions = 0
+        while frontier and remaining:
+            if self.max_depth is not None and depth >= self.max_depth:
+                break
+            if self.landmarks is not None and self.max_depth is not None:
+                # Don't expand nodes from which no remaining target is within max_depth.
+                bounds = np.min([self.landmarks.lower_bounds(frontier, target) for target in remaining], axis=0)
+                frontier = [node for node, bound in zip(frontier, bounds.tolist()) if depth + bound <= self.max_depth]
+            next_frontier = []
+            for node in frontier:
+                expansions += 1
+                if not remaining or (self.max_expansions is not None and expansions > self.max_expansions):
+                    return parents
+                neighbors, relations, _ = self.store.edges(node)
+                for next_node, relation in zip(neighbors.tolist(), relations.tolist()):
+                    if next_node in parents: continue
+                    parents[next_node] = (node, relation)
+                    remaining.discard(next_node)
+                    next_frontier.append(next_node)
+            depth += 1
+            frontier = next_frontier
+        return parents
+
+    # The path from the start of a search to node, following its parent pointers.
+    def _path_to(self, node, parents):
+        path = []
+        while parents[node] is not None:
+            previous, relation = parents[node]
+            path.append((previous, relation, node))
+            node = previous
+        path.reverse()
+        return [(self.store.name(w1), self.store.relations[relation], self.store.name(w2)) for w1, relation, w2 in path]
+
+    # Look the POS tag up in the store, only running spacy on unknown words.
+    def _pos(self, word):
+        node_id = self.store.node_id(word)
+        pos = self.store.pos(node_id) if node_id is not None else 0
+        if not pos:
+            pos = get_pos_model()(word)[0].pos
+        return pos
 
     def _get_predicate(self, word, relation, var):
         property_pos_tags = [symbols.ADV, symbols.ADJ]
         # TODO: POS tagger inaccuracte with word out of ctx.
-        pos = model(word)[0].pos
+        pos = self._pos(word)
         if pos in property_pos_tags:
             return f'property({word}, {var})'
         if relation == 'UsedFor':
@@ -221,22 +314,49 @@ class ConceptNetTranslation:
                 print(f'Warning. No handler for {relation}.')
         return rules
 
-    def build(self, unused_background_knowledge, test, test_predicates):
+    def _pair_key(self, start, end):
+        return RecordStore.key(start, end, self.max_depth, self.max_expansions, self.rules_version)
+
+    """
+    Return the rules from the paths between start and each of the ends.
+    The path and rules for each pair are cached, and only the pairs which
+    are not in the cache are searched for.
+    """
+    def rules_between(self, start, ends):
+        rules = set()
+        missing = []
+        for end in ends:
+            entry = self.rule_cache.get(self._pair_key(start, end))
+            if entry is None:
+                missing.append(end)
+            else:
+                rules.update(entry['rules'])
+        profiling.count('conceptnet.cached', len(ends) - len(missing))
+        if missing:
+            with profiling.span('path_search'):
+                paths = self.find_paths(start, missing)
+            for end in missing:
+                path = paths.get(end)
+                profiling.count('conceptnet.path' if path else 'conceptnet.no_path')
+                pair_rules = sorted(self._path_to_rules(path)) if path else []
+                self.rule_cache.put(self._pair_key(start, end), {'path': path, 'rules': pair_rules})
+                rules.update(pair_rules)
+        return rules
+
+    def build(self, unused_background_knowledge, test, test_predicates, debug_dir='.'):
         candidates = test.get_correct_candidate().split() + test.get_incorrect_candidate().split() + ['_'.join(test.get_correct_candidate().split())] + ['_'.join(test.get_incorrect_candidate().split())]
         starting = self.get_relevant_predicates(test_predicates, candidates, set(candidates))
         end = self.get_relevant_predicates(test_predicates, [self.pronoun_symbol], set([self.pronoun_symbol]))
+        if not starting or not end:
+            # There are no words to search between.
+            profiling.count('conceptnet.no_words')
         rules = set()
         for s in starting:
-            for e in end:
-                path = self.find_path_if_it_exists(s, e)
-                if path is None: continue
-                rules = rules | set(self._path_to_rules(path))
-        rules.add(f'coref({self.pronoun_symbol}, Y) :- property(P, {self.pronoun_symbol}), property(P, Y), Y != {self.pronoun_symbol}.')
-        rules.add(f'coref({self.pronoun_symbol}, Y) :- event_subject(E, {self.pronoun_symbol}), event_subject(E, Y), Y != {self.pronoun_symbol}.')
-        rules.add(f'coref({self.pronoun_symbol}, Y) :- event_object(E, {self.pronoun_symbol}), event_object(E, Y), Y != {self.pronoun_symbol}.')
+            rules = rules | self.rules_between(s, end)
+        rules.update(coref_rules(self.pronoun_symbol))
         test_facts = [p.grounded() for p in test_predicates]
         program = '\n'.join(test_facts + list(rules))
         if self.debug:
-            with open('concept_net_program.lp', 'w') as writer:
+            with open(os.path.join(debug_dir, 'concept_net_program.lp'), 'w') as writer:
                 writer.write(program)
         return program
@@ -0,0 +1,98 @@
+import argparse
+import json
+import sys
+
+# The metrics compared between runs, and whether higher values are better.
+metrics = {
+    'examples_per_second': True,
+    'peak_rss_mb': False,
+    'accuracy': True,
+}
+# The span latencies compared between runs (lower is better).
+span_metrics = ['p50', 'p95']
+
+def load_runs(filename):
+    with open(filename, 'r') as f:
+        results = json.load(f)
+    return results, {run['name']: run for run in results['runs'] if run['returncode'] == 0}
+
+# The relative change from before to after, signed so that positive is worse.
+def regression(before, after, higher_is_better):
+    if before == 0:
+        return 0.0
+    change = (after - before) / abs(before)
+    return -change if higher_is_better else change
+
+"""
+Compare every metric of the runs present (and successful) in both results.
+Returns rows of (run, metric, before, after, relative change where positive
+is worse, whether it is a regression).
+"""
+def compare(baseline, candidate, tolerance, accuracy_tolerance, min_seconds):
+    rows = []
+    for name in sorted(set(baseline) & set(candidate)):
+        before, after = baseline[name], candidate[name]
+        for metric, higher_is_better in metrics.items():
+            if before.get(metric) is None or after.get(metric) is None:
+                continue
+            change = regression(before[metric], after[metric], higher_is_better)
+            if metric == 'accuracy':
+                # Accuracy is compared in absolute terms.
+                change = before[metric] - after[metric]
+                regressed = change > accuracy_tolerance
+            else:
+                regressed = change > tolerance
+            rows.append((name, metric, before[metric], after[metric], change, regressed))
+        for span in sorted(set(before['spans']) & set(after['spans'])):
+            for statistic in span_metrics:
+                b, a = before['spans'][span][statistic], after['spans'][span][statistic]
+                change = regression(b, a, False)
+                # Ignore changes in spans too short to measure reliably.
+                regressed = change > tolerance and a - b > min_seconds
+                rows.append((name, f'{span}.{statistic}', b, a, change, regressed))
+    return rows
+
+def main(args):
+    baseline_results, baseline = load_runs(args.baseline)
+    candidate_results, candidate = load_runs(args.candidate)
+    print(f'Baseline: {args.baseline} (commit {baseline_results.get("commit")})')
+    print(f'Candidate: {args.candidate} (commit {candidate_results.get("commit")})')
+    for name in sorted(set(baseline) ^ set(candidate)):
+        print(f'WARNING: {name} only succeeded in {"the baseline" if name in baseline else "the candidate"}, it is not compared.')
+    rows = compare(baseline, candidate, args.tolerance, args.accuracy_tolerance, args.min_seconds)
+    regressions = [row for row in rows if row[5]]
+    for name, metric, before, after, change, regressed in (rows if args.all else regressions):
+        flag = 'REGRESSION' if regressed else ''
+        print(f'{name:45} {metric:28} {before:12.4f} -> {after:12.4f} {change:+8.1%} {flag}')
+    print(f'{len(regressions)} regressions in {len(rows)} comparisons.')
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files, flagging regressions. Exits with 1 if there are any.')
+    parser.add_argument(
+        'baseline',
+        help='The results of the baseline run.')
+    parser.add_argument(
+        'candidate',
+        help='The results of the run to check.')
+    parser.add_argument(
+        '--tolerance',
+        default=0.1,
+        type=float,
+        help='The relative change in throughput, memory or latency treated as a regression.')
+    parser.add_argument(
+        '--accuracy_tolerance',
+        default=0.0,
+        type=float,
+        help='The absolute drop in accuracy treated as a regression.')
+    parser.add_argument(
+        '--min_seconds',
+        default=0.005,
+        type=float,
+        help='Latency increases smaller than this many seconds are never regressions.')
+    parser.add_argument(
+        '--all',
+        default=False,
+        action='store_true',
+        help='Print every comparison, not only the regressions.')
+    main(parser.parse_args())
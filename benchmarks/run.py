@@ -0,0 +1,220 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+import jsonlines
+
+# The repository root, where main.py is run from (it expects lib/ there).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ILASP = 'ILASPTranslation'
+CONCEPTNET = 'ConceptNetTranslation'
+# Names swapped in for the candidates of synthetic training examples.
+names = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj',
+    'Olivia', 'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter', 'Yvonne']
+
+def read_jsonl(filename):
+    with jsonlines.open(filename) as reader:
+        return list(reader.iter(skip_empty=True))
+
+def write_jsonl(filename, rows):
+    with jsonlines.open(filename, 'w') as writer:
+        writer.write_all(rows)
+
+# A copy of the example with both candidates replaced by new names.
+def rename_candidates(row, random_state):
+    first, second = random_state.sample(names, 2)
+    sentence = row['sentence'].replace(row['option1'], first).replace(row['option2'], second)
+    return dict(row, sentence=sentence, option1=first, option2=second, qID=f'synthetic-{random_state.getrandbits(32):08x}')
+
+"""
+A training corpus of size examples: a random subsample of source if it is
+large enough, otherwise all of source, topped up with copies of its examples
+with the candidates renamed.
+"""
+def make_corpus(source, size, seed):
+    random_state = random.Random(seed)
+    if size <= len(source):
+        return random_state.sample(source, size)
+    return source + [rename_candidates(random_state.choice(source), random_state) for _ in range(size - len(source))]
+
+"""
+Every configuration to run. ne and mode only apply to ILASPTranslation, so
+ConceptNetTranslation is run once per corpus size.
+"""
+def configurations(args):
+    for corpus_size, model in itertools.product(args.corpus_sizes, args.models):
+        if model == ILASP:
+            for ne, mode in itertools.product(args.ne, args.modes):
+                yield {'corpus_size': corpus_size, 'model_name': model, 'ne': ne, 'mode': mode}
+        else:
+            yield {'corpus_size': corpus_size, 'model_name': model, 'ne': args.ne[0], 'mode': args.modes[0]}
+
+def config_name(config):
+    return f'{config["model_name"]}-n{config["corpus_size"]}-ne{config["ne"]}-{config["mode"]}'
+
+"""
+Run main.py on one configuration, returning the time taken, the peak RSS of
+the run (including any worker processes) and the profile report it wrote.
+"""
+def run_one(config, train_filename, test_filename, args):
+    name = config_name(config)
+    report_filename = os.path.join(args.out_dir, 'reports', f'{name}.json')
+    log_filename = os.path.join(args.out_dir, 'logs', f'{name}.log')
+    # Each run gets an empty cache, unless cached results are wanted.
+    cache_dir = os.path.join(args.out_dir, 'cache' if args.warm_cache else os.path.join('caches', name))
+    if not args.warm_cache:
+        # Left over from an earlier sweep into the same out_dir.
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    command = [
+        sys.executable, 'main.py',
+        '--train_path', train_filename,
+        '--test_path', test_filename,
+        '--ne', str(config['ne']),
+        '--model_name', config['model_name'],
+        '--mode', config['mode'],
+        '--cache_dir', cache_dir,
+        '--workers', str(args.workers),
+        '--profile_report', report_filename,
+    ]
+    start = time.perf_counter()
+    with open(log_filename, 'w') as log:
+        process = subprocess.Popen(command, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of the run, ru_maxrss being the
+        # peak RSS (in KB on linux) of the process or its largest child.
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    seconds = time.perf_counter() - start
+    report = {}
+    if os.path.exists(report_filename):
+        with open(report_filename, 'r') as f:
+            report = json.load(f)
+    return {
+        'name': name,
+        'config': config,
+        'returncode': process.returncode,
+        'seconds': seconds,
+        'examples_per_second': args.test_size / seconds,
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'accuracy': report.get('accuracy'),
+        'unknown': report.get('unknown'),
+        'spans': report.get('spans', {}),
+        'counts': report.get('counts', {}),
+        'log': log_filename,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main(args):
+    # main.py runs from the repository root.
+    args.out_dir = os.path.abspath(args.out_dir)
+    for directory in ['data', 'reports', 'logs']:
+        os.makedirs(os.path.join(args.out_dir, directory), exist_ok=True)
+    test = read_jsonl(args.test_path)[args.test_offset:args.test_offset + args.test_size]
+    args.test_size = len(test)
+    test_filename = os.path.join(args.out_dir, 'data', 'test.jsonl')
+    write_jsonl(test_filename, test)
+    source = read_jsonl(args.train_path)
+    train_filenames = {}
+    for corpus_size in args.corpus_sizes:
+        train_filenames[corpus_size] = os.path.join(args.out_dir, 'data', f'train-{corpus_size}.jsonl')
+        write_jsonl(train_filenames[corpus_size], make_corpus(source, corpus_size, args.seed))
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'args': vars(args),
+        'runs': [],
+    }
+    for config in configurations(args):
+        print(f'Running {config_name(config)}', flush=True)
+        run = run_one(config, os.path.abspath(train_filenames[config['corpus_size']]), os.path.abspath(test_filename), args)
+        print(f'  {run["seconds"]:.1f}s, {run["examples_per_second"]:.3f} examples/s, peak RSS {run["peak_rss_mb"]:.0f}MB, accuracy {run["accuracy"]}', flush=True)
+        if run['returncode'] != 0:
+            print(f'  WARNING: exited with {run["returncode"]}, see {run["log"]}', flush=True)
+        results['runs'].append(run)
+        # Written after every run, so a sweep that is cut short still has results.
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(f'Results written to {args.results}')
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+def str_list(value):
+    return value.split(',')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the solver on a fixed slice of the test data, over training corpora of increasing size.')
+    parser.add_argument(
+        '--train_path',
+        default=os.path.join(ROOT, 'data', 'train_xl.jsonl'),
+        help='The training data to subsample. Corpora larger than it are topped up with synthetic examples.')
+    parser.add_argument(
+        '--test_path',
+        default=os.path.join(ROOT, 'data', 'wsc273.jsonl'),
+        help='The test data.')
+    parser.add_argument(
+        '--test_offset',
+        default=0,
+        type=int,
+        help='The first test example of the slice to solve.')
+    parser.add_argument(
+        '--test_size',
+        default=20,
+        type=int,
+        help='The number of test examples to solve.')
+    parser.add_argument(
+        '--corpus_sizes',
+        default=[1000, 4000, 16000],
+        type=int_list,
+        help='Comma separated sizes of the training corpora.')
+    parser.add_argument(
+        '--ne',
+        default=[1, 3],
+        type=int_list,
+        help='Comma separated values of --ne.')
+    parser.add_argument(
+        '--modes',
+        default=['batch', 'iterative'],
+        type=str_list,
+        help='Comma separated learning modes.')
+    parser.add_argument(
+        '--models',
+        default=[ILASP, CONCEPTNET],
+        type=str_list,
+        help='Comma separated models.')
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of processes solving test examples in each run.')
+    parser.add_argument(
+        '--warm_cache',
+        default=False,
+        action='store_true',
+        help='Share one cache directory between runs, instead of starting each run with an empty cache.')
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Seed used to sample the training corpora.')
+    parser.add_argument(
+        '--out_dir',
+        default=os.path.join(ROOT, 'benchmarks', 'out'),
+        help='Directory for the sampled data, logs, reports and caches of the runs.')
+    parser.add_argument(
+        '--results',
+        default='results.json',
+        help='The file the results are written to.')
+    main(parser.parse_args())
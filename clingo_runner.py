@@ -1,28 +1,176 @@
 import clyngor
 import shutil
 import os
+import tempfile
+import threading
+import profiling
 clyngor.CLINGO_BIN_PATH = 'lib/clingo'
+# The clingo python module is optional, without it programs are solved by
+# running lib/clingo through clyngor.
+try:
+    import clingo
+    import clingo.ast
+except ImportError:
+    clingo = None
+
+if clingo is not None:
+    """
+    Adds the step as the first argument of every atom it visits.
+    """
+    class StepTagger(clingo.ast.Transformer):
+        def __init__(self, step):
+            self.step = step
+
+        def visit_SymbolicAtom(self, atom):
+            return atom.update(symbol=self._tag(atom.symbol))
+
+        def _tag(self, symbol):
+            # A strongly negated atom, e.g. -property(small, Y), is a unary minus over the atom.
+            if symbol.ast_type == clingo.ast.ASTType.UnaryOperation:
+                return symbol.update(argument=self._tag(symbol.argument))
+            if symbol.ast_type != clingo.ast.ASTType.Function:
+                return symbol
+            return symbol.update(arguments=[self.step] + list(symbol.arguments))
 
 """
 Compute the answer sets of a program and return coreferences.
 """
 class AspRunner:
     debug_filename = 'debug_asp_runner'
-    def __init__(self):
-        self.models = []
+    # Number of programs solved by one multi-shot control before it is replaced,
+    # so that retired programs don't accumulate forever.
+    max_steps = 1000
+
+    """
+    backend (string): One of {auto, clingo, clyngor}. clingo solves in process
+        with the clingo python module, clyngor runs a clingo subprocess per
+        program. auto uses clingo if it is installed.
+    base_rules (list(string)): Rules shared by every program. If given (which
+        needs the clingo backend), programs are solved with multi-shot solving:
+        the base rules are parsed once into a persistent control, and each
+        program is added as a new part, with its atoms tagged by its step and
+        guarded by an external atom which is released once it has been solved.
+        Lines of a program equal to a base rule are not added again.
+    """
+    def __init__(self, backend='auto', base_rules=None):
+        if backend == 'auto':
+            backend = 'clyngor' if clingo is None else 'clingo'
+        assert backend in ['clingo', 'clyngor'], 'Unknown backend specified. Choose one of {auto, clingo, clyngor}'
+        assert backend != 'clingo' or clingo is not None, 'The clingo python module is not installed.'
+        self.backend = backend
         self.program_run = False
         self.errors = 0
-        if not os.path.exists(self.debug_filename):
-            os.makedirs(self.debug_filename)
-            #shutil.rmtree(self.debug_filename)
+        assert base_rules is None or backend == 'clingo', 'Multi-shot solving needs the clingo python module.'
+        self.base_rules = base_rules
+        self.control = None
+        self.lock = threading.Lock()
+        # Several worker processes may create the directory at once.
+        os.makedirs(self.debug_filename, exist_ok=True)
+
+    def _solve_with_clyngor(self, program):
+        models = clyngor.solve(inline=program)
+        return set([r for answer in models.by_predicate for r in map(lambda args: args[1], answer.get('coref') or [])])
+
+    def _solve_in_process(self, program):
+        messages = []
+        # '0' enumerates all answer sets, as clyngor does.
+        control = clingo.Control(['0'], logger=lambda code, message: messages.append(message))
+        coreferences = set()
+        def on_model(model):
+            for symbol in model.symbols(shown=True):
+                if symbol.name == 'coref' and len(symbol.arguments) == 2:
+                    coreferences.add(str(symbol.arguments[1]))
+        try:
+            control.add('base', [], program)
+            control.ground([('base', [])])
+            control.solve(on_model=on_model)
+        except RuntimeError as e:
+            raise SystemError('\n'.join(messages + [str(e)]))
+        return coreferences
+
+    def _new_control(self):
+        self.messages = []
+        self.control = clingo.Control(['0'], logger=lambda code, message: self.messages.append(message))
+        # The shared rules are grounded for each step s, over the atoms of that step.
+        step = clingo.ast.Function(self._location(), 's', [], 0)
+        self._add_part('\n'.join(self.base_rules), 'shared(s)', step, 'active(s)')
+        self.steps = 0
+
+    def _location(self):
+        position = clingo.ast.Position('<multi_shot>', 1, 1)
+        return clingo.ast.Location(position, position)
+
+    """
+    Add the program as a part called name, with every atom tagged with the
+    step (as an extra first argument), so that the atoms of a step never
+    redefine, or are seen by, those of another step. The guard is added to
+    the body of every rule, so the part is retired once it is released.
+    """
+    def _add_part(self, program, name, step, guard):
+        guard_body = []
+        clingo.ast.parse_string(f':- {guard}.', lambda statement: guard_body.extend(statement.body) if statement.ast_type == clingo.ast.ASTType.Rule else None)
+        tagger = StepTagger(step)
+        def add(builder, statement):
+            if statement.ast_type == clingo.ast.ASTType.Rule:
+                statement = tagger(statement)
+                statement = statement.update(body=list(statement.body) + guard_body)
+            builder.add(statement)
+        with clingo.ast.ProgramBuilder(self.control) as builder:
+            clingo.ast.parse_string(f'#program {name}.\n{program}', lambda statement: add(builder, statement))
+
+    def _solve_multi_shot(self, program):
+        base_rules = set(self.base_rules)
+        program = '\n'.join(line for line in program.split('\n') if line not in base_rules)
+        with self.lock:
+            if self.control is None or self.steps >= self.max_steps:
+                self._new_control()
+            self.messages.clear()
+            self.steps += 1
+            step = clingo.Number(self.steps)
+            active = clingo.Function('active', [step])
+            coreferences = set()
+            def on_model(model):
+                # Only the atoms of this step are read, e.g. coref(step, target_pronoun, Y).
+                for symbol in model.symbols(shown=True):
+                    if symbol.name == 'coref' and len(symbol.arguments) == 3 and symbol.arguments[0] == step:
+                        coreferences.add(str(symbol.arguments[2]))
+            try:
+                self._add_part(program, f'step_{self.steps}', clingo.ast.SymbolicTerm(self._location(), step), f'active({self.steps})')
+                self.control.add(f'step_{self.steps}', [], f'#external active({self.steps}).')
+                self.control.ground([(f'step_{self.steps}', []), ('shared', [step])])
+                self.control.assign_external(active, True)
+                self.control.solve(on_model=on_model)
+                self.control.release_external(active)
+                self.control.cleanup()
+            except RuntimeError as e:
+                messages = list(self.messages)
+                # The control may be left part way through a step, so start again.
+                self.control = None
+                raise SystemError('\n'.join(messages + [str(e)]))
+        return coreferences
 
-    def run(self, program):
+    """
+    program (string): The ASP program to solve.
+    debug_dir (string): Where to save the program if it fails. A new file in
+        debug_filename is used if None.
+    """
+    def run(self, program, debug_dir=None):
         try:
-            self.models = clyngor.solve(inline=program)
-            coreferences = set([r for answer in self.models.by_predicate for r in map(lambda args: args[1], answer.get('coref') or [])])
+            with profiling.span('clingo'):
+                if self.base_rules is not None:
+                    coreferences = self._solve_multi_shot(program)
+                elif self.backend == 'clingo':
+                    coreferences = self._solve_in_process(program)
+                else:
+                    coreferences = self._solve_with_clyngor(program)
         except SystemError as e:
-            debug_file = f'{self.debug_filename}_{str(self.errors)}'
-            with open(f'{self.debug_filename}/{debug_file}', 'w') as f:
+            profiling.count('clingo.error')
+            if debug_dir is None:
+                fd, debug_file = tempfile.mkstemp(prefix=f'{self.debug_filename}_', dir=self.debug_filename)
+                os.close(fd)
+            else:
+                debug_file = os.path.join(debug_dir, f'{self.debug_filename}_{str(self.errors)}')
+            with open(debug_file, 'w') as f:
                 f.write('Failed program is: \n')
                 f.write(program)
                 f.write('\n\n\n\n\n')
@@ -1,16 +1,22 @@
-import requests
+import argparse
+import asyncio
+import json
 import jsonlines
+import os
+import requests
 import time
 from collections import deque
-import json
 
 db = 'db.jsonl'
 db_shortcuts = 'locations.json'
+state_filename = 'crawl_state.json'
+# Used to start a crawl when there is no state file.
 next_words_filename = 'next_words.txt'
 seen_words_filename = 'seen_words.txt'
 # Number of nodes to retrieve before aborting.
 limit = 40000
-ONE_SECOND = 1
+# Max number of requests per second.
+rate = 1
 
 # Download data from conceptnet
 class ConceptNet:
@@ -28,12 +34,19 @@ class ConceptNet:
     'UsedFor',
     'ObstructedBy',
     ])
+
+    """
+    base_url: Where the ConceptNet API is served, e.g. a local mock_server.py.
+    """
+    def __init__(self, base_url='http://api.conceptnet.io'):
+        self.base_url = base_url.rstrip('/')
+
     # Given a term, returns a line in jsonlines format, with
     # the key being the word and the entry being a list of pairs,
     # word and relation
-    def fetch(self, term):
+    async def fetch(self, term):
         term = '_'.join(term.split())
-        results = self.search(term)
+        results = await self.search(term)
         terms, next_words = self.get_next_words(results, term)
         return terms, next_words
 
@@ -69,32 +82,221 @@ class ConceptNet:
         }
         return entry, next_word, float(edge['weight'])
 
-    def search(self, term):
-        url = f'http://api.conceptnet.io/c/en/{term}?limit=300'
-        res = requests.get(url)
+    async def search(self, term):
+        url = f'{self.base_url}/c/en/{term}?limit=300'
+        # requests blocks, so it is run in the default thread pool.
+        res = await asyncio.get_event_loop().run_in_executor(None, requests.get, url)
+        res.raise_for_status()
         return res.json()
 
-with open(next_words_filename, 'r') as f:
-    next_words = deque([word.strip() for word in f.readlines() if word != ''])
-with open(seen_words_filename, 'r') as f:
-    seen = [word.strip() for word in f.readlines() if word != '']
-
-c = ConceptNet()
-
-while next_words:
-    if limit == 0: break
-    word = next_words.popleft()
-    if word in seen: continue
-    t, w = c.fetch(word)
-    time.sleep(ONE_SECOND)
-    seen.append(word)
-    next_words.extend(w)
-    with open(seen_words_filename, 'a') as f:
-        f.write(word + '\n')
-    with open(next_words_filename, 'a') as f:
-        f.write('\n'.join(w))
-    with jsonlines.open(db, 'a') as f:
-        f.write(t)
-    limit = limit - 1
-
-print(f'LIMIT REACHED, ABORTING, limit: {limit}')
+"""
+Limits requests to rate per second on average, allowing bursts of up to
+capacity requests.
+"""
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+"""
+Crawl conceptnet breadth first from the frontier, with up to concurrency
+requests in flight. Fetched nodes are appended to the db in batches of
+batch_size, and the seen words and frontier are checkpointed to the state
+file after each batch, along with the size of the db. A crawl started with
+an existing state file resumes from it, first truncating anything written to
+the db after the last checkpoint.
+"""
+class Crawler:
+    # Number of times a word is retried before it is dropped.
+    max_attempts = 3
+
+    def __init__(self, conceptnet, db_filename=db, state=state_filename, concurrency=4, rate=rate, burst=1, batch_size=100, limit=limit):
+        self.conceptnet = conceptnet
+        self.db_filename = db_filename
+        self.state_filename = state
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.batch_size = batch_size
+        self.remaining = limit
+        self.seen = set()
+        self.frontier = deque()
+        # The words in the frontier, so that a word is only queued once.
+        self.queued = set()
+        self.in_flight = set()
+        self.attempts = {}
+        self.batch = []
+
+    """
+    Start a new crawl from the given words, skipping the seen words.
+    """
+    def start(self, words, seen=()):
+        self.seen = set(seen)
+        self._queue(words)
+        self.checkpoint()
+
+    def resume(self):
+        with open(self.state_filename, 'r') as f:
+            state = json.load(f)
+        self.seen = set(state['seen'])
+        self._queue(state['frontier'])
+        # Drop nodes written after the last checkpoint, they are still in the frontier.
+        if os.path.exists(self.db_filename) and os.path.getsize(self.db_filename) > state['db_size']:
+            os.truncate(self.db_filename, state['db_size'])
+
+    def checkpoint(self):
+        db_size = os.path.getsize(self.db_filename) if os.path.exists(self.db_filename) else 0
+        state = {
+            'seen': list(self.seen),
+            # Words being fetched are not finished, so are crawled again on resuming.
+            'frontier': list(self.in_flight) + list(self.frontier),
+            'db_size': db_size,
+        }
+        temp_filename = f'{self.state_filename}.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_filename, self.state_filename)
+
+    def flush(self):
+        if self.batch:
+            with jsonlines.open(self.db_filename, 'a') as f:
+                f.write_all(self.batch)
+            self.batch = []
+        self.checkpoint()
+
+    # Add the words to the frontier, unless they are seen, queued or being fetched.
+    def _queue(self, words):
+        for word in words:
+            if word not in self.seen and word not in self.queued and word not in self.in_flight:
+                self.queued.add(word)
+                self.frontier.append(word)
+
+    async def _crawl(self, word, bucket):
+        await bucket.acquire()
+        try:
+            return word, await self.conceptnet.fetch(word), None
+        except Exception as e:
+            return word, None, e
+
+    def _finish(self, word, result, error):
+        self.in_flight.discard(word)
+        if error is not None:
+            self.attempts[word] = self.attempts.get(word, 0) + 1
+            if self.attempts[word] < self.max_attempts:
+                self._queue([word])
+            print(f'WARNING: Failed to fetch {word} (attempt {self.attempts[word]}): {error}')
+            return
+        terms, next_words = result
+        self.seen.add(word)
+        self._queue(next_words)
+        self.batch.append(terms)
+        self.remaining -= 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    async def run(self):
+        bucket = TokenBucket(self.rate, self.burst)
+        pending = set()
+        while self.remaining > 0 and (self.frontier or pending):
+            while self.frontier and len(pending) < min(self.concurrency, self.remaining):
+                word = self.frontier.popleft()
+                self.queued.discard(word)
+                self.in_flight.add(word)
+                pending.add(asyncio.ensure_future(self._crawl(word, bucket)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._finish(*task.result())
+        for task in pending:
+            self._finish(*await task)
+        self.flush()
+
+def read_words(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as f:
+        return [word.strip() for word in f.readlines() if word.strip() != '']
+
+def main(args):
+    crawler = Crawler(
+        ConceptNet(args.base_url),
+        db_filename=args.db,
+        state=args.state,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        burst=args.burst,
+        batch_size=args.batch_size,
+        limit=args.limit)
+    if os.path.exists(args.state):
+        crawler.resume()
+    else:
+        crawler.start(read_words(args.start_words), read_words(args.seen_words))
+    asyncio.run(crawler.run())
+    if crawler.remaining == 0:
+        print(f'LIMIT REACHED, ABORTING, limit: {args.limit}')
+    else:
+        print(f'Crawl finished, {len(crawler.seen)} words seen.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download data from conceptnet.')
+    parser.add_argument(
+        '--base_url',
+        default='http://api.conceptnet.io',
+        help='The conceptnet API to crawl, e.g. http://localhost:8084 for mock_server.py.')
+    parser.add_argument(
+        '--db',
+        default=db,
+        help='The jsonl file fetched nodes are appended to.')
+    parser.add_argument(
+        '--state',
+        default=state_filename,
+        help='The file the crawl is checkpointed to, and resumed from if it exists.')
+    parser.add_argument(
+        '--start_words',
+        default=next_words_filename,
+        help='The words to start crawling from, one per line. Only used if there is no state file.')
+    parser.add_argument(
+        '--seen_words',
+        default=seen_words_filename,
+        help='Words which are never crawled, one per line. Only used if there is no state file.')
+    parser.add_argument(
+        '--limit',
+        default=limit,
+        type=int,
+        help='The max number of nodes to fetch in this run.')
+    parser.add_argument(
+        '--concurrency',
+        default=4,
+        type=int,
+        help='The max number of requests in flight.')
+    parser.add_argument(
+        '--rate',
+        default=rate,
+        type=float,
+        help='The max number of requests per second, on average.')
+    parser.add_argument(
+        '--burst',
+        default=1,
+        type=int,
+        help='The max number of requests sent at once after being idle.')
+    parser.add_argument(
+        '--batch_size',
+        default=100,
+        type=int,
+        help='The number of nodes written to the db (and state file) at once.')
+    main(parser.parse_args())
@@ -1,43 +1,38 @@
-import jsonlines
-import json
-import queue
-from operator import itemgetter
+import os
+import sys
+from collections import deque
+# Run from the repository root, as python conceptnet/get_depth.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conceptnet_store import ConceptNetStore, build_landmarks
+
 def _bfs(current, visited, depth):
-    waiting = queue.Queue()
-    waiting.put((current, 0))
+    waiting = deque([(current, 0)])
     old_depth = depth
     while waiting:
-        try:
-            (curr, depth) = waiting.get_nowait()
-        except Exception as e:
-            return depth
+        (curr, depth) = waiting.popleft()
         if depth > old_depth:
             old_depth = depth
             print(f'Depth is {depth}')
         if curr in visited: continue
         visited.add(curr)
-        next = _find_node_if_present(curr)
-        if next is None: continue
-        for edge in next:
-            next_word = edge['name']
-            waiting.put_nowait((next_word, depth + 1))
+        neighbors, _, _ = store.edges(curr)
+        for next_id in neighbors.tolist():
+            waiting.append((next_id, depth + 1))
     return depth
 
-db_file = []
-with jsonlines.open('conceptnet/db.jsonl', 'r') as f:
-    for line in f:
-        db_file.append(line)
-with open('conceptnet/node_locations.json', 'r') as f:
-    node_locations = json.load(f)
+store = ConceptNetStore.open()
 with open('conceptnet/starting_words.txt', 'r') as f:
     starting_words = [word.strip() for word in f.readlines() if word != '']
 
-def _find_node_if_present(name):
-    if not name in node_locations:
-        return None
-    l = node_locations[name]
-    return db_file[l][name]
-
 depths = []
+seeds = []
 for word in starting_words:
-    depths.append(_bfs(word, set(), 0))
+    node_id = store.node_id(word)
+    if node_id is None or not store.crawled[node_id]:
+        depths.append(0)
+        continue
+    seeds.append(node_id)
+    depths.append(_bfs(node_id, set(), 0))
+
+# Index reachability from the starting words, used to skip hopeless path searches.
+build_landmarks(store, seeds)
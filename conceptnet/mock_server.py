@@ -0,0 +1,86 @@
+import argparse
+import hashlib
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+"""
+A local stand-in for the conceptnet API, for testing conceptnet.py without
+sending requests to api.conceptnet.io. GET /c/en/<term> returns the canned
+response for term if one was given, otherwise a made up (but deterministic)
+response, with edges from term to words in a small synthetic vocabulary.
+"""
+relations = ['IsA', 'RelatedTo', 'CapableOf', 'Synonym', 'HasProperty', 'UsedFor', 'AtLocation']
+
+def node(label, language='en'):
+    return {'label': label, 'language': language}
+
+def synthetic_response(term, num_edges=20, vocabulary_size=5000):
+    edges = []
+    for i in range(num_edges):
+        digest = hashlib.sha1(f'{term}/{i}'.encode('utf-8')).digest()
+        other = f'word {int.from_bytes(digest[:4], "little") % vocabulary_size}'
+        edge = {
+            'rel': {'label': relations[digest[4] % len(relations)]},
+            'weight': 1 + digest[5] / 64,
+        }
+        # Edges point both ways, and a few are to other languages.
+        language = 'fr' if digest[6] % 10 == 0 else 'en'
+        if digest[7] % 2:
+            edge['start'], edge['end'] = node(term), node(other, language)
+        else:
+            edge['start'], edge['end'] = node(other, language), node(term)
+        edges.append(edge)
+    return {'@id': f'/c/en/{term}', 'edges': edges}
+
+class Handler(BaseHTTPRequestHandler):
+    # Set by main.
+    responses = {}
+    latency = 0.0
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        prefix = '/c/en/'
+        if not path.startswith(prefix):
+            self.send_error(404)
+            return
+        term = unquote(path[len(prefix):])
+        time.sleep(self.latency)
+        response = self.responses.get(term) or synthetic_response(term)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main(args):
+    if args.responses:
+        with open(args.responses, 'r') as f:
+            Handler.responses = json.load(f)
+    Handler.latency = args.latency
+    server = ThreadingHTTPServer(('localhost', args.port), Handler)
+    print(f'Serving conceptnet on http://localhost:{server.server_port}')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve canned conceptnet responses locally.')
+    parser.add_argument(
+        '--port',
+        default=8084,
+        type=int,
+        help='The port to serve on.')
+    parser.add_argument(
+        '--responses',
+        default=None,
+        help='A json file mapping terms to conceptnet responses. Other terms get a synthetic response.')
+    parser.add_argument(
+        '--latency',
+        default=0.0,
+        type=float,
+        help='Seconds to wait before answering each request, to simulate the real API.')
+    main(parser.parse_args())
@@ -0,0 +1,395 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+from array import array
+import jsonlines
+import numpy as np
+
+# Bump when the layout of the store changes, so old stores get rebuilt.
+STORE_VERSION = 3
+DEFAULT_DIRECTORY = 'conceptnet/graph'
+DEFAULT_DB = 'conceptnet/db.jsonl'
+DEFAULT_LOCATIONS = 'conceptnet/node_locations.json'
+DEFAULT_LANDMARKS = 'conceptnet/landmarks'
+# The spacy model used to tag the part of speech of every node label.
+POS_MODEL = 'en_core_web_sm'
+# Distance used in the landmark tables for nodes that can't be reached.
+UNREACHABLE = 255
+
+"""
+A compact, memory-mapped copy of the crawled ConceptNet graph.
+Every node label (crawled words, and the names at the end of their edges) is
+interned in a sorted string table, so a node is an integer id. Edges are kept
+in CSR form: the edges of node i are indptr[i]:indptr[i+1] of the neighbors,
+relations (an index into the relation names) and weights arrays. The sources
+of the edges into each node are kept the same way (reverse_indptr and
+reverse_sources), for the landmark distances to each node. Optionally,
+the part of speech of every label (as tagged by POS_MODEL) is kept too.
+All arrays are memory-mapped, so opening a store is near instant and processes
+sharing a store share one copy in the page cache.
+"""
+class ConceptNetStore:
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        assert self.meta['version'] == STORE_VERSION, f'Store in {directory} is out of date, rebuild it with conceptnet_store.py.'
+        self.directory = directory
+        self.relations = self.meta['relations']
+        # Changes every time the store is built, so results derived from it can be invalidated.
+        self.build_id = self.meta['build_id']
+        load = lambda name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        self.name_bytes = load('names')
+        self.name_offsets = load('name_offsets')
+        self.crawled = load('crawled')
+        self.indptr = load('indptr')
+        self.neighbors = load('neighbors')
+        self.edge_relations = load('relations')
+        self.weights = load('weights')
+        self.reverse_indptr = load('reverse_indptr')
+        self.reverse_sources = load('reverse_sources')
+        self.pos_tags = load('pos') if self.meta['pos_model'] else None
+
+    # Whether the store in directory is up to date, and was built from the crawl as it is now.
+    @staticmethod
+    def _is_current(directory, db_filename, locations_filename):
+        meta_filename = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_filename):
+            return False
+        with open(meta_filename, 'r') as f:
+            meta = json.load(f)
+        sources = _source_stats(db_filename, locations_filename)
+        # Without the crawl, the store can't be rebuilt, so is used as it is.
+        return meta['version'] == STORE_VERSION and (sources is None or meta.get('sources') == sources)
+
+    """
+    Open the store in directory, building it from the crawl first if it does
+    not exist, is out of date, or the crawl has changed since it was built. When several processes open a missing store
+    at once (e.g., the workers of main.py), one builds it while the others
+    wait, so they all share the same build.
+    """
+    @staticmethod
+    def open(directory=DEFAULT_DIRECTORY, db_filename=DEFAULT_DB, locations_filename=DEFAULT_LOCATIONS, pos_model=POS_MODEL):
+        if not ConceptNetStore._is_current(directory, db_filename, locations_filename):
+            with _build_lock(directory):
+                # Another process may have built it while this one waited.
+                if not ConceptNetStore._is_current(directory, db_filename, locations_filename):
+                    build(db_filename, locations_filename, directory, pos_model)
+        return ConceptNetStore(directory)
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def _name_bytes(self, node_id):
+        return self.name_bytes[self.name_offsets[node_id]:self.name_offsets[node_id + 1]].tobytes()
+
+    def name(self, node_id):
+        return self._name_bytes(node_id).decode('utf-8')
+
+    # Return the id of the node with the given label, or None if there isn't one.
+    def node_id(self, name):
+        key = name.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._name_bytes(low) == key:
+            return low
+        return None
+
+    # Return the neighbor ids, relation codes and weights of the edges from node_id.
+    def edges(self, node_id):
+        start, end = self.indptr[node_id], self.indptr[node_id + 1]
+        return self.neighbors[start:end], self.edge_relations[start:end], self.weights[start:end]
+
+    # The spacy POS id of the node's label, or 0 if it is not known.
+    def pos(self, node_id):
+        if self.pos_tags is None:
+            return 0
+        return int(self.pos_tags[node_id])
+
+    # Whether node_id is a crawled word with at least one edge.
+    def has_edges(self, node_id):
+        return node_id is not None and bool(self.crawled[node_id]) and self.indptr[node_id + 1] > self.indptr[node_id]
+
+    """
+    Return the edges of a crawled word, in the format of the crawl
+    ({name, relation, weight}), or None if the word was not crawled.
+    """
+    def find_edges(self, name):
+        node_id = self.node_id(name)
+        if node_id is None or not self.crawled[node_id]:
+            return None
+        neighbors, relations, weights = self.edges(node_id)
+        return [
+            {'name': self.name(n), 'relation': self.relations[r], 'weight': float(w)}
+            for n, r, w in zip(neighbors.tolist(), relations.tolist(), weights.tolist())]
+
+"""
+An index answering reachability questions about a ConceptNetStore without searching.
+It holds the weakly connected component of every node, and the distances
+from and to a set of landmark nodes (as in ALT search). Nodes in different
+components can't reach each other, and by the triangle inequality the
+landmark distances give a lower bound on the distance between any two nodes.
+"""
+class LandmarkIndex:
+    def __init__(self, directory=DEFAULT_LANDMARKS):
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.build_id = self.meta['build_id']
+        self.landmarks = self.meta['landmarks']
+        load = lambda name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        self.components = load('components')
+        # Shape (landmarks, nodes): distance from each landmark, and to each landmark.
+        self.distances_from = load('distances_from')
+        self.distances_to = load('distances_to')
+
+    """
+    Open the index for the given store, or return None if there is no index
+    or it was built for a different version of the store.
+    """
+    @staticmethod
+    def open(store, directory=DEFAULT_LANDMARKS):
+        meta_filename = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_filename):
+            return None
+        index = LandmarkIndex(directory)
+        if index.build_id != store.build_id:
+            print(f'Warning. Ignoring {directory}, it was built for a different conceptnet store.')
+            return None
+        return index
+
+    # Whether there may be a path from start to goal. If False, there is none.
+    def reachable(self, start, goal):
+        if self.components[start] != self.components[goal]:
+            return False
+        from_start, from_goal = self.distances_from[:, start], self.distances_from[:, goal]
+        # A landmark reaching start, but not goal, means start can't reach goal.
+        if np.any((from_start != UNREACHABLE) & (from_goal == UNREACHABLE)):
+            return False
+        to_start, to_goal = self.distances_to[:, start], self.distances_to[:, goal]
+        # Likewise for goal reaching a landmark which start can't.
+        return not np.any((to_goal != UNREACHABLE) & (to_start == UNREACHABLE))
+
+    # A lower bound on the length of a path from each of starts to goal.
+    def lower_bounds(self, starts, goal):
+        from_starts = self.distances_from[:, starts].astype(np.int32)
+        from_goal = self.distances_from[:, goal].astype(np.int32)[:, None]
+        to_starts = self.distances_to[:, starts].astype(np.int32)
+        to_goal = self.distances_to[:, goal].astype(np.int32)[:, None]
+        bounds = np.zeros(len(starts), dtype=np.int32)
+        known = (from_starts != UNREACHABLE) & (from_goal != UNREACHABLE)
+        bounds = np.maximum(bounds, np.where(known, from_goal - from_starts, 0).max(axis=0, initial=0))
+        known = (to_starts != UNREACHABLE) & (to_goal != UNREACHABLE)
+        return np.maximum(bounds, np.where(known, to_starts - to_goal, 0).max(axis=0, initial=0))
+
+# The size and modification time of the crawl files, or None if they are missing.
+def _source_stats(db_filename, locations_filename):
+    if not os.path.exists(db_filename) or not os.path.exists(locations_filename):
+        return None
+    stats = {}
+    for name, filename in [('db', db_filename), ('locations', locations_filename)]:
+        stat = os.stat(filename)
+        stats[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return stats
+
+# Held while building into directory, so only one process builds it at a time.
+@contextmanager
+def _build_lock(directory):
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    with open(os.path.join(parent, f'.{os.path.basename(os.path.abspath(directory))}.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# A new directory next to directory to build into, so that a partially built
+# store (or index) is never opened, even by another process.
+def _staging_directory(directory):
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix='.staging-', dir=parent)
+
+# Rename the staging directory into place, replacing directory if it exists.
+# Processes with the old files memory-mapped keep reading them until they close.
+def _install(staging, directory):
+    if not os.path.isdir(directory):
+        os.rename(staging, directory)
+        return
+    retired = tempfile.mkdtemp(prefix='.retired-', dir=os.path.dirname(os.path.abspath(directory)))
+    os.rename(directory, os.path.join(retired, 'old'))
+    os.rename(staging, directory)
+    shutil.rmtree(retired, ignore_errors=True)
+
+# Breadth first search distances from source to every node, over CSR arrays.
+def _bfs_distances(indptr, indices, source):
+    distances = np.full(len(indptr) - 1, UNREACHABLE, dtype=np.uint8)
+    distances[source] = 0
+    frontier = np.array([source], dtype=np.int64)
+    depth = 0
+    while frontier.size and depth < UNREACHABLE - 1:
+        depth += 1
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        # Positions of every edge out of the frontier.
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        neighbors = np.asarray(indices[positions], dtype=np.int64)
+        frontier = np.unique(neighbors[distances[neighbors] == UNREACHABLE])
+        distances[frontier] = depth
+    return distances
+
+# Label every node with the smallest id in its weakly connected component.
+def _weak_components(store):
+    labels = np.arange(len(store), dtype=np.int64)
+    sources = np.repeat(labels, np.diff(store.indptr))
+    targets = np.asarray(store.neighbors, dtype=np.int64)
+    while True:
+        lowest = np.minimum(labels[sources], labels[targets])
+        updated = labels.copy()
+        np.minimum.at(updated, sources, lowest)
+        np.minimum.at(updated, targets, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+"""
+Build a LandmarkIndex for the store in directory.
+Landmarks are picked from seeds (node ids) farthest first: the seed with most
+edges, then each time the seed farthest from the landmarks picked so far.
+"""
+def build_landmarks(store, seeds, count=16, directory=DEFAULT_LANDMARKS):
+    seeds = list(dict.fromkeys(seeds))
+    degrees = np.diff(store.indptr)
+    landmarks, distances_from, distances_to = [], [], []
+    closest = np.full(len(seeds), np.iinfo(np.int32).max, dtype=np.int64)
+    while seeds and len(landmarks) < count:
+        if not landmarks:
+            landmark = max(seeds, key=lambda seed: degrees[seed])
+        else:
+            landmark = seeds[int(np.argmax(closest))]
+            if closest.max() == 0:
+                break
+        landmarks.append(int(landmark))
+        distances_from.append(_bfs_distances(store.indptr, store.neighbors, landmark))
+        distances_to.append(_bfs_distances(store.reverse_indptr, store.reverse_sources, landmark))
+        closest = np.minimum(closest, distances_from[-1][seeds].astype(np.int64))
+    staging = _staging_directory(directory)
+    save = lambda name, value: np.save(os.path.join(staging, f'{name}.npy'), value)
+    save('components', _weak_components(store).astype(np.int32))
+    save('distances_from', np.array(distances_from, dtype=np.uint8).reshape(len(landmarks), len(store)))
+    save('distances_to', np.array(distances_to, dtype=np.uint8).reshape(len(landmarks), len(store)))
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump({
+            'build_id': store.build_id,
+            'landmarks': [store.name(landmark) for landmark in landmarks],
+        }, f)
+    with _build_lock(directory):
+        _install(staging, directory)
+
+# Tag the first token of every label, as tagging the label on its own would.
+def _tag_labels(names, pos_model):
+    import spacy
+    nlp = spacy.load(pos_model, disable=['parser', 'ner'])
+    tags = np.zeros(len(names), dtype=np.uint16)
+    for i, doc in enumerate(nlp.pipe(names, batch_size=1024)):
+        if len(doc):
+            tags[i] = doc[0].pos
+    return tags
+
+"""
+Convert the crawl (db.jsonl, and node_locations.json which gives the line
+each crawled word is on) into a store in directory.
+pos_model (string): The spacy model to tag node labels with, or None to skip tagging.
+"""
+def build(db_filename, locations_filename, directory, pos_model=POS_MODEL):
+    # Taken before reading, so a crawl changed while building is built again.
+    source_stats = _source_stats(db_filename, locations_filename)
+    with open(locations_filename, 'r') as f:
+        locations = json.load(f)
+    # Names are given provisional ids in the order they are seen, then sorted.
+    provisional = {}
+    intern = lambda name: provisional.setdefault(name, len(provisional))
+    relations = {}
+    sources, targets, edge_relations, weights = array('q'), array('q'), array('B'), array('f')
+    crawled = array('q')
+    with jsonlines.open(db_filename, 'r') as reader:
+        for line_number, line in enumerate(reader):
+            for name, edges in line.items():
+                # Only the line node_locations points at is used, as before.
+                if locations.get(name) != line_number:
+                    continue
+                source = intern(name)
+                crawled.append(source)
+                for edge in edges:
+                    sources.append(source)
+                    targets.append(intern(edge['name']))
+                    edge_relations.append(relations.setdefault(edge['relation'], len(relations)))
+                    weights.append(float(edge['weight']))
+    # Sorting str by code point gives the same order as sorting the utf-8 bytes.
+    names = sorted(provisional)
+    final_ids = np.empty(len(names), dtype=np.int64)
+    for node_id, name in enumerate(names):
+        final_ids[provisional[name]] = node_id
+    encoded = [name.encode('utf-8') for name in names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(e) for e in encoded])
+    sources = final_ids[np.frombuffer(sources, dtype=np.int64)] if sources else np.empty(0, dtype=np.int64)
+    targets = final_ids[np.frombuffer(targets, dtype=np.int64)] if targets else np.empty(0, dtype=np.int64)
+    # A stable sort keeps the edges of each node in their crawled order.
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(names)))
+    is_crawled = np.zeros(len(names), dtype=np.bool_)
+    if crawled:
+        is_crawled[final_ids[np.frombuffer(crawled, dtype=np.int64)]] = True
+    staging = _staging_directory(directory)
+    save = lambda name, value: np.save(os.path.join(staging, f'{name}.npy'), value)
+    save('names', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    save('name_offsets', name_offsets)
+    save('crawled', is_crawled)
+    save('indptr', indptr)
+    edge_relations = np.frombuffer(edge_relations, dtype=np.uint8)
+    save('neighbors', targets[order].astype(np.int32))
+    save('relations', edge_relations[order])
+    save('weights', np.frombuffer(weights, dtype=np.float32)[order])
+    reverse_order = np.argsort(targets, kind='stable')
+    reverse_indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    reverse_indptr[1:] = np.cumsum(np.bincount(targets, minlength=len(names)))
+    save('reverse_indptr', reverse_indptr)
+    save('reverse_sources', sources[reverse_order].astype(np.int32))
+    if pos_model:
+        save('pos', _tag_labels(names, pos_model))
+    relation_names = [None] * len(relations)
+    for relation, code in relations.items():
+        relation_names[code] = relation
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': STORE_VERSION,
+            'build_id': uuid.uuid4().hex,
+            'relations': relation_names,
+            'nodes': len(names),
+            'edges': int(indptr[-1]),
+            'pos_model': pos_model,
+            'sources': source_stats,
+        }, f)
+    _install(staging, directory)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the memory-mapped ConceptNet store from the crawl.')
+    parser.add_argument('--db', default=DEFAULT_DB, help='The crawled ConceptNet database, in jsonl format.')
+    parser.add_argument('--locations', default=DEFAULT_LOCATIONS, help='The line of each crawled word in the database.')
+    parser.add_argument('--out', default=DEFAULT_DIRECTORY, help='Directory to write the store to.')
+    parser.add_argument('--pos_model', default=POS_MODEL, help='The spacy model used to tag node labels. Pass an empty string to skip tagging.')
+    args = parser.parse_args()
+    with _build_lock(args.out):
+        build(args.db, args.locations, args.out, args.pos_model or None)
@@ -0,0 +1,219 @@
+import json
+import os
+import resource
+import signal
+import threading
+import time
+from collections import defaultdict, deque
+from subprocess import Popen, PIPE, TimeoutExpired
+import numpy as np
+import profiling
+
+# The default (and max) seconds given to one ILASP task.
+DEFAULT_TIMEOUT = 200
+
+class IlaspCancelled(Exception):
+    pass
+
+"""
+The size of an ILASP task: its number of examples and of mode declarations.
+"""
+def task_size(program):
+    examples = 0
+    modes = 0
+    for line in program.split('\n'):
+        if line.startswith('#pos(') or line.startswith('#neg('):
+            examples += 1
+        elif line.startswith('#modeh(') or line.startswith('#modeb('):
+            modes += 1
+    return examples, modes
+
+# Tasks of similar size share timing history: sizes are bucketed by powers of two.
+def size_bucket(size):
+    examples, modes = size
+    return f'{int(examples).bit_length()}-{int(modes).bit_length()}'
+
+"""
+The outcome of one ILASP job.
+status: One of ok, unsat (ILASP ran to completion), timeout (the job's time
+    ran out), budget (cut short, or never started, as the run's time budget
+    ran out), cpu_limit or error (e.g., it ran out of memory).
+output: The learnt hypothesis, or '' unless the status is ok.
+partial_output: Anything printed by a job which was cut short.
+timeout: The seconds the job was given.
+"""
+class IlaspJob:
+    def __init__(self, status, output, seconds, timeout, size, partial_output='', returncode=None):
+        self.status = status
+        self.output = output
+        self.seconds = seconds
+        self.timeout = timeout
+        self.size = size
+        self.partial_output = partial_output
+        self.returncode = returncode
+
+"""
+Runs ILASP jobs, each in its own process group, with resource limits, a
+timeout, and a wall clock budget shared by every job of the run.
+A job whose time runs out is sent SIGINT, and SIGKILL if it is still running
+grace_period seconds later. Anything left in its process group (e.g., clingo)
+is killed once it has exited.
+If adaptive, the timeout of a job is learnt from how long earlier jobs of a
+similar size took to finish: the given quantile of their durations, times
+slack, kept between min_timeout and timeout. Until min_samples jobs of that
+size have finished, jobs get the full timeout. Durations are appended to
+history_filename (if given), so later runs start with them.
+Jobs which were cut short (or not started) are recorded as profiling events.
+"""
+class IlaspScheduler:
+    # How often (in seconds) a running job checks for cancellation.
+    poll_interval = 0.5
+    # The durations kept for each size bucket.
+    history_size = 200
+
+    """
+    timeout (int): The seconds given to each job, or the most given if adaptive.
+    adaptive (boolean): If true, learn the timeout of each job from earlier jobs.
+    deadline (float): The time (as given by time.time()) by which every job
+        must have finished, shared by all the processes of a run. Unlimited if None.
+    cpu_limit (int): The CPU seconds each ILASP process may use. Unlimited if None.
+    memory_limit (int): The address space, in MB, each ILASP process may use. Unlimited if None.
+    history_filename (string): The file job durations are kept in.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, adaptive=False, deadline=None, cpu_limit=None, memory_limit=None, history_filename=None,
+            quantile=95, slack=2.0, min_timeout=10, min_samples=10, grace_period=5):
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.deadline = deadline
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.history_filename = history_filename
+        self.quantile = quantile
+        self.slack = slack
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        self.history = defaultdict(lambda: deque(maxlen=self.history_size))
+        if history_filename is not None and os.path.exists(history_filename):
+            with open(history_filename, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.history[size_bucket((entry['examples'], entry['modes']))].append(entry['seconds'])
+
+    """
+    The seconds a job of the given size would be given, ignoring the budget.
+    """
+    def timeout_for(self, size):
+        if not self.adaptive:
+            return self.timeout
+        with self.lock:
+            durations = list(self.history[size_bucket(size)])
+        if len(durations) < self.min_samples:
+            return self.timeout
+        timeout = np.percentile(durations, self.quantile) * self.slack
+        return float(min(max(timeout, self.min_timeout), self.timeout))
+
+    def remaining_budget(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def _record(self, size, seconds):
+        with self.lock:
+            self.history[size_bucket(size)].append(seconds)
+            if self.history_filename is not None:
+                line = json.dumps({'examples': size[0], 'modes': size[1], 'seconds': seconds}) + '\n'
+                # Small appends are atomic, so processes can share the file.
+                with open(self.history_filename, 'a') as f:
+                    f.write(line)
+
+    # Applied to the job once it has started, as preexec_fn isn't safe when
+    # jobs are started from several threads. Anything the job starts later
+    # (e.g., clingo) inherits the limits.
+    def _limit_resources(self, process):
+        try:
+            if self.cpu_limit is not None:
+                # SIGXCPU at the soft limit, SIGKILL at the hard limit.
+                resource.prlimit(process.pid, resource.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit + self.grace_period))
+            if self.memory_limit is not None:
+                # RLIMIT_RSS isn't enforced by linux, so the address space is limited instead.
+                limit = self.memory_limit * 1024 * 1024
+                resource.prlimit(process.pid, resource.RLIMIT_AS, (limit, limit))
+        except ProcessLookupError:
+            # The job has already finished.
+            pass
+
+    def _kill_group(self, process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    # Stop the job: SIGINT, then SIGKILL if it is still running after the grace period.
+    # Returns anything it printed.
+    def _reap(self, process):
+        self._kill_group(process, signal.SIGINT)
+        try:
+            output = process.communicate(timeout=self.grace_period)[0]
+        except TimeoutExpired:
+            self._kill_group(process, signal.SIGKILL)
+            output = process.communicate()[0]
+        return output.decode('utf-8', errors='replace')
+
+    def _cut_short(self, job, name):
+        profiling.recorder.event('ilasp.cut_short', task=name, status=job.status, examples=job.size[0], modes=job.size[1],
+            timeout=job.timeout, seconds=job.seconds)
+        return job
+
+    """
+    Run the ILASP command, whose task has the given size.
+    name (string): Identifies the task in the events recorded if it is cut short.
+    timeout (float): The seconds to give the job, timeout_for(size) if None.
+    cancel (threading.Event): If set while the job is running, it is stopped
+        and IlaspCancelled is raised.
+    Returns an IlaspJob.
+    """
+    def run(self, command, size, name=None, timeout=None, cancel=None):
+        timeout = self.timeout_for(size) if timeout is None else timeout
+        remaining = self.remaining_budget()
+        if remaining is not None and remaining <= 0:
+            return self._cut_short(IlaspJob('budget', '', 0.0, 0.0, size), name)
+        limited_by_budget = remaining is not None and remaining < timeout
+        if limited_by_budget:
+            timeout = remaining
+        start = time.monotonic()
+        deadline = start + timeout
+        # Each job gets its own session (and so process group), to be killed as a whole.
+        with Popen(command, stdout=PIPE, start_new_session=True) as process:
+            try:
+                self._limit_resources(process)
+                while True:
+                    wait = max(deadline - time.monotonic(), 0)
+                    if cancel is not None:
+                        wait = min(wait, self.poll_interval)
+                    try:
+                        output = process.communicate(timeout=wait)[0].decode('utf-8', errors='replace')
+                        break
+                    except TimeoutExpired:
+                        if cancel is not None and cancel.is_set():
+                            self._reap(process)
+                            raise IlaspCancelled()
+                        if time.monotonic() >= deadline:
+                            partial_output = self._reap(process)
+                            job = IlaspJob('budget' if limited_by_budget else 'timeout', '', time.monotonic() - start, timeout, size, partial_output, process.returncode)
+                            return self._cut_short(job, name)
+            finally:
+                # Don't leave anything the job started running.
+                self._kill_group(process, signal.SIGKILL)
+        seconds = time.monotonic() - start
+        if process.returncode == -signal.SIGXCPU or (process.returncode == -signal.SIGKILL and self.cpu_limit is not None):
+            return self._cut_short(IlaspJob('cpu_limit', '', seconds, timeout, size, output, process.returncode), name)
+        if process.returncode != 0 and 'UNSATISFIABLE' not in output:
+            return self._cut_short(IlaspJob('error', '', seconds, timeout, size, output, process.returncode), name)
+        self._record(size, seconds)
+        # Program is treated as empty if it was UNSATISFIABLE.
+        if 'UNSATISFIABLE' in output:
+            return IlaspJob('unsat', '', seconds, timeout, size, returncode=process.returncode)
+        return IlaspJob('ok', output, seconds, timeout, size, returncode=process.returncode)
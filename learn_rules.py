@@ -0,0 +1,117 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from main import add_solver_arguments, create_solver, start_ilasp_budget
+from rule_library import RuleLibrary
+from sentence_finder import file_digest
+import profiling
+
+"""
+Group the training examples into clusters of up to size similar examples.
+Each example not yet in a cluster starts a new one, joined by those of its
+most similar examples which are not in a cluster either.
+"""
+def find_clusters(solver, size, batch_size):
+    if size == 1:
+        return [[i] for i in range(len(solver.corpus))]
+    clustered = set()
+    clusters = []
+    for start in range(0, len(solver.corpus), batch_size):
+        batch = range(start, min(start + batch_size, len(solver.corpus)))
+        indices, _ = solver.sentence_finder.get_many([solver.corpus[i].get_masked_sentence() for i in batch])
+        for i, row in zip(batch, indices):
+            if i in clustered:
+                continue
+            cluster = [i] + [j for j in row.tolist() if j != i and j not in clustered][:size - 1]
+            clustered.update(cluster)
+            clusters.append(cluster)
+    return clusters
+
+# Learn a hypothesis from one cluster, returning its rules.
+def learn_cluster(solver, cluster, n):
+    background = [(solver.corpus[i], solver.get_predicates(solver.corpus[i])) for i in cluster]
+    builder = solver.program_builder
+    debug_dir = solver.get_debug_dir(f'cluster-{n}') or '.'
+    try:
+        return builder.learn(builder.build_ilasp_program(background, debug_dir=debug_dir))
+    except Exception as e:
+        profiling.count('learn_rules.error')
+        print(f'WARNING: Could not learn from cluster {n} ({cluster}), due to Error: {e}')
+        return ''
+
+def main(args):
+    start_ilasp_budget(args)
+    args.model_name = 'ILASPTranslation'
+    solver = create_solver(args.train_path, args)
+    start = time.perf_counter()
+    with profiling.span('clustering'):
+        clusters = find_clusters(solver, args.ne, args.batch_size)
+    if args.limit is not None:
+        clusters = clusters[:args.limit]
+    print(f'Learning from {len(clusters)} clusters of up to {args.ne} training examples.')
+    # Every predicate is extracted up front, as the extractor is not thread
+    # safe. Sentences are parsed a batch at a time, so their docs don't all
+    # stay in memory at once.
+    indices = [i for cluster in clusters for i in cluster]
+    for offset in range(0, len(indices), args.batch_size):
+        batch = [solver.corpus[i] for i in indices[offset:offset + args.batch_size]]
+        solver.semantic_extractor.parse_many(
+            [example.get_sentence() for example in batch if solver._predicate_key(example.get_sentence()) not in solver.predicate_store],
+            batch_size=args.batch_size, n_process=args.n_process)
+        for example in batch:
+            solver.get_predicates(example)
+    library = RuleLibrary(metadata={
+        'train_path': args.train_path,
+        'train_digest': file_digest(args.train_path),
+        'ne': args.ne,
+        'ilasp_timeout': args.ilasp_timeout,
+        'min_support': args.min_support,
+    })
+    # ILASP runs in its own process, so threads are enough to run several at once.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        hypotheses = executor.map(lambda indexed: learn_cluster(solver, indexed[1], indexed[0]), enumerate(clusters))
+        for n, (cluster, hypothesis) in enumerate(zip(clusters, hypotheses)):
+            library.add(hypothesis, cluster)
+            if (n + 1) % args.log_every == 0:
+                print(f'Learnt from {n + 1} of {len(clusters)} clusters in {time.perf_counter() - start:.0f}s, {len(library)} distinct rules.', flush=True)
+    library.reindex(args.min_support)
+    library.save(args.rule_library)
+    print(f'Saved {len(library)} rules to {args.rule_library}.')
+    counts = profiling.recorder.summary()['counts']
+    print(f'ILASP tasks: {counts.get("ilasp.ok", 0)} learnt, {counts.get("ilasp.unsat", 0)} UNSATISFIABLE, '
+        f'{counts.get("ilasp.timeout", 0) + counts.get("ilasp.budget", 0)} out of time, {counts.get("ilasp.cached", 0)} cached.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Learn a library of rules from the training data ahead of time, for RuleLibraryTranslation.')
+    add_solver_arguments(parser)
+    parser.add_argument(
+        '--batch_size',
+        default=256,
+        type=int,
+        help='The number of sentences parsed (and searched for similar sentences) together.')
+    parser.add_argument(
+        '--n_process',
+        default=1,
+        type=int,
+        help='The number of processes spacy uses when parsing sentences up front.')
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of ILASP tasks run at once.')
+    parser.add_argument(
+        '--min_support',
+        default=1,
+        type=int,
+        help='Only keep rules learnt from at least this many clusters.')
+    parser.add_argument(
+        '--limit',
+        default=None,
+        type=int,
+        help='Only learn from the first LIMIT clusters.')
+    parser.add_argument(
+        '--log_every',
+        default=100,
+        type=int,
+        help='Print progress after every LOG_EVERY clusters.')
+    main(parser.parse_args())
@@ -1,6 +1,15 @@
 import argparse
+import contextlib
+from collections import Counter
+import io
 import jsonlines
+import multiprocessing
+import sys
 import numpy as np
+import os
+import profiling
+import time
+from ilasp_scheduler import IlaspScheduler
 from wsc_solver import Solver
 
 SENTENCE = 'sentence'
@@ -8,33 +17,144 @@ CANDIDATE_1 = 'option1'
 CANDIDATE_2 = 'option2'
 ANSWER = 'answer'
 
-def main(train_filename, test_filename, args):
-    predictions = []
-    target = []
-    examples = ''
-    num_correct = 0
-    solver = Solver(
+def create_scheduler(args):
+    cache_dir = args.cache_dir or None
+    return IlaspScheduler(
+        timeout=args.ilasp_timeout,
+        adaptive=args.ilasp_adaptive,
+        deadline=args.ilasp_deadline,
+        cpu_limit=args.ilasp_cpu_limit,
+        memory_limit=args.ilasp_memory_limit,
+        history_filename=os.path.join(cache_dir, 'ilasp-timings.jsonl') if cache_dir else None)
+
+# Start the time budget of the ILASP tasks, shared by every worker.
+def start_ilasp_budget(args):
+    args.ilasp_deadline = time.time() + args.ilasp_budget if args.ilasp_budget else None
+
+def create_solver(train_filename, args):
+    return Solver(
         train_filename,
         num_examples_per_input=args.ne,
         debug=args.d,
         model_name=args.model_name,
-        mode=args.mode)
+        mode=args.mode,
+        cache_dir=args.cache_dir or None,
+        multi_shot=args.multi_shot,
+        retrieval=args.retrieval,
+        ilasp_scheduler=create_scheduler(args),
+        rule_library=args.rule_library,
+        conceptnet_max_depth=args.conceptnet_max_depth,
+        conceptnet_max_expansions=args.conceptnet_max_expansions)
+
+# The solver (and args) of a worker process, created once by _init_worker.
+worker_solver = None
+worker_args = None
+
+def _init_worker(train_filename, args):
+    global worker_solver, worker_args
+    worker_solver = create_solver(train_filename, args)
+    worker_args = args
+
+# Solve a chunk of the test examples in a worker. The chunk is prepared
+# first, so its sentences are parsed and searched for in batches. Anything
+# printed is captured, so that the parent can print it in the same order as
+# the test examples. The timings recorded are sent back too, to be merged by
+# the parent.
+def _solve_in_worker(indexed_examples):
+    out, err = io.StringIO(), io.StringIO()
+    results = []
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        with profiling.span('prepare'):
+            # Pool workers are daemons, which can't start more processes.
+            worker_solver.prepare([test_example for _, test_example in indexed_examples], batch_size=worker_args.batch_size, n_process=1)
+        for i, test_example in indexed_examples:
+            with profiling.profiled(profile_filename(worker_args, i, test_example)):
+                answer, additional_info = worker_solver.solve(test_example)
+            results.append((answer, additional_info, out.getvalue(), err.getvalue()))
+            for stream in [out, err]:
+                stream.seek(0)
+                stream.truncate()
+    return results, profiling.recorder.take()
+
+# Split the test examples into chunks for the workers: no larger than a
+# batch, and small enough that every worker gets several.
+def chunks(test_examples, args):
+    size = max(1, min(args.batch_size, -(-len(test_examples) // (args.workers * 4))))
+    indexed = list(enumerate(test_examples))
+    return [indexed[start:start + size] for start in range(0, len(indexed), size)]
+
+# Where the cProfile stats of solving the i-th test example are saved, or None.
+def profile_filename(args, i, test_example):
+    if not args.profile_dir:
+        return None
+    return os.path.join(args.profile_dir, f'{test_example.get("qID") or i}.prof')
+
+"""
+Yield the answer, additional info and printed output for each test example,
+in order. With more than one worker the examples are solved in a process pool.
+"""
+def solve_all(train_filename, test_examples, args):
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(train_filename, args)) as pool:
+            for results, samples in pool.imap(_solve_in_worker, chunks(test_examples, args)):
+                profiling.recorder.merge(samples)
+                yield from results
+        return
+    with profiling.span('startup'):
+        solver = create_solver(train_filename, args)
+    with profiling.span('prepare'):
+        solver.prepare(test_examples, batch_size=args.batch_size, n_process=args.n_process)
+    if args.retrieval != 'exact':
+        report_retrieval(solver, test_examples)
+    for i, test_example in enumerate(test_examples):
+        with profiling.profiled(profile_filename(args, i, test_example)):
+            result = solver.solve(test_example)
+        yield result + ('', '')
+
+# Compare the approximate retrieval backend against exact search on the test sentences.
+def report_retrieval(solver, test_examples):
+    queries = [solver._to_problem(example).get_masked_sentence() for example in test_examples]
+    report = solver.sentence_finder.evaluate(queries)
+    print(f'Retrieval backend: {report["backend"]}')
+    print(f'Recall@{solver.sentence_finder.k} against exact search: {report["recall_at_k"]}')
+    print(f'Seconds per query: {report["seconds_per_query"]} (exact: {report["exact_seconds_per_query"]})')
+
+def get_prediction(answer, test_example):
+    if answer is None:
+        return 0
+    elif answer in test_example[CANDIDATE_1].lower():
+        return 1
+    elif answer in test_example[CANDIDATE_2].lower():
+        return 2
+    return 0
+
+def main(train_filename, test_filename, args):
+    start = time.perf_counter()
+    predictions = []
+    target = []
     with jsonlines.open(test_filename) as reader:
-        for test_example in reader:
-            target.append(int(test_example[ANSWER]))
-            answer, additional_info = solver.solve(test_example)
-            if answer is None:
-                predictions.append(0)
-            elif answer in test_example[CANDIDATE_1].lower():
-                predictions.append(1)
-            elif answer in test_example[CANDIDATE_2].lower():
-                predictions.append(2)
-            else:
-                predictions.append(0)
-            if args.d and predictions[-1] == int(test_example[ANSWER]):
-                with jsonlines.open('correct_answers.jsonl', 'a') as f:
-                    f.write(additional_info)
+        test_examples = list(reader)
+    start_ilasp_budget(args)
+    results = solve_all(train_filename, test_examples, args)
+    for test_example, (answer, additional_info, out, err) in zip(test_examples, results):
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        target.append(int(test_example[ANSWER]))
+        predictions.append(get_prediction(answer, test_example))
+        if args.d and predictions[-1] == int(test_example[ANSWER]):
+            with jsonlines.open('correct_answers.jsonl', 'a') as f:
+                f.write(additional_info)
     print_performance(predictions, target)
+    print_cut_short()
+    if args.profile_report:
+        stats = calculate_stats(predictions, target)
+        profiling.recorder.write_report(
+            args.profile_report,
+            seconds=time.perf_counter() - start,
+            workers=args.workers,
+            accuracy=float(stats['accuracy']),
+            unknown=int(stats['unknown']))
+        print(f'Profile report written to {args.profile_report}')
 
 def print_performance(predictions, target):
     stats = calculate_stats(predictions, target)
@@ -43,6 +163,12 @@ def print_performance(predictions, target):
     print(f'Number of correct: {stats["correct"]}')
     print(f'Accuracy: {stats["accuracy"]}')
 
+def print_cut_short():
+    cut_short = [event for event in profiling.recorder.events if event['name'] == 'ilasp.cut_short']
+    if cut_short:
+        reasons = Counter(event['status'] for event in cut_short)
+        print(f'ILASP tasks cut short: {len(cut_short)} ({", ".join(f"{reason}: {n}" for reason, n in sorted(reasons.items()))})')
+
 def calculate_stats(predictions, target):
     predictions = np.array(predictions)
     target = np.array(target)
@@ -57,14 +183,13 @@ def calculate_stats(predictions, target):
         'accuracy': num_correct / num_examples
     }
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Solve WSC problems.')
+"""
+Add the arguments used to create a solver, shared with server.py.
+"""
+def add_solver_arguments(parser):
     parser.add_argument(
         '--train_path',
         help='The path to the input file for training')
-    parser.add_argument(
-        '--test_path',
-        help='The path to the input file for evaluation data.')
     parser.add_argument(
         '--ne',
         default='1',
@@ -78,13 +203,96 @@ if __name__ == '__main__':
     parser.add_argument(
         '--model_name',
         default='ILASPTranslation',
-        help='The model to use, one of {ConceptNetTranslation, ILASPTranslation}'
+        help='The model to use, one of {ConceptNetTranslation, ILASPTranslation, RuleLibraryTranslation}'
     )
     parser.add_argument(
         '--mode',
         default='iterative',
-        help='The learning mode, one of {batch, iterative}. Only applies to ILASPTranslation'
+        help='The learning mode, one of {batch, iterative, speculative}. Only applies to ILASPTranslation'
     )
+    parser.add_argument(
+        '--cache_dir',
+        default='cache',
+        help='Directory where results are cached between runs. Pass an empty string to disable caching.')
+    parser.add_argument(
+        '--multi_shot',
+        default=False,
+        action='store_true',
+        help='Solve every program in one persistent clingo control, sharing the coref rules. Requires the clingo python module.')
+    parser.add_argument(
+        '--retrieval',
+        default='exact',
+        choices=['exact', 'lsh', 'dense'],
+        help='How similar training sentences are found: exact TF-IDF search, locality sensitive hashing over TF-IDF, or word vectors of the spacy model.')
+    parser.add_argument(
+        '--ilasp_timeout',
+        default=200,
+        type=float,
+        help='The seconds given to each ILASP task, or the most given with --ilasp_adaptive.')
+    parser.add_argument(
+        '--ilasp_adaptive',
+        default=False,
+        action='store_true',
+        help='Learn the timeout of each ILASP task from how long earlier tasks of a similar size took.')
+    parser.add_argument(
+        '--ilasp_budget',
+        default=None,
+        type=float,
+        help='The seconds all ILASP tasks of the run may take, after which they are cut short. Unlimited if not given.')
+    parser.add_argument(
+        '--ilasp_cpu_limit',
+        default=None,
+        type=int,
+        help='The CPU seconds each ILASP process may use.')
+    parser.add_argument(
+        '--ilasp_memory_limit',
+        default=None,
+        type=int,
+        help='The memory (address space, in MB) each ILASP process may use.')
+    parser.add_argument(
+        '--rule_library',
+        default='rule_library.json',
+        help='The rules learnt ahead of time by learn_rules.py, used by RuleLibraryTranslation.')
+    parser.add_argument(
+        '--conceptnet_max_depth',
+        default=None,
+        type=int,
+        help='The longest path ConceptNetTranslation searches for between two words. With a landmark index, searches are also pruned to it. Unbounded if not given.')
+    parser.add_argument(
+        '--conceptnet_max_expansions',
+        default=None,
+        type=int,
+        help='The max number of nodes expanded by one ConceptNet path search. Unbounded if not given.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve WSC problems.')
+    add_solver_arguments(parser)
+    parser.add_argument(
+        '--test_path',
+        help='The path to the input file for evaluation data.')
+    parser.add_argument(
+        '--batch_size',
+        default=256,
+        type=int,
+        help='The number of sentences parsed together by spacy.')
+    parser.add_argument(
+        '--n_process',
+        default=1,
+        type=int,
+        help='The number of processes spacy uses when parsing sentences up front.')
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of processes solving test examples in parallel.')
+    parser.add_argument(
+        '--profile_report',
+        default=None,
+        help='Write a JSON report of the time spent in each stage (with p50/p95/max latencies) and counts of timeouts, UNSAT tasks and missing paths to this file.')
+    parser.add_argument(
+        '--profile_dir',
+        default=None,
+        help='Profile solving each test example with cProfile, saving the stats to this directory.')
     args = parser.parse_args()
     main(
         args.train_path,
@@ -0,0 +1,114 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+"""
+Collects how long each stage of the pipeline takes (spans), and how often
+notable events happen (counts), e.g. ILASP timing out. The durations of the
+spans with the same name are summarised as latency percentiles. Events which
+need looking into (e.g., which ILASP tasks were cut short) can be kept in full.
+"""
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = defaultdict(list)
+        self.counts = Counter()
+        self.events = []
+
+    """
+    Time the block, recording it as a span called name.
+    """
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.spans[name].append(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def event(self, name, **fields):
+        with self.lock:
+            self.events.append(dict(fields, name=name))
+
+    """
+    Return everything recorded so far, and start again. Used to send the
+    samples of a worker process to the parent, which merges them.
+    """
+    def take(self):
+        with self.lock:
+            samples = {'spans': dict(self.spans), 'counts': dict(self.counts), 'events': self.events}
+            self.spans = defaultdict(list)
+            self.counts = Counter()
+            self.events = []
+        return samples
+
+    def merge(self, samples):
+        with self.lock:
+            for name, seconds in samples['spans'].items():
+                self.spans[name].extend(seconds)
+            self.counts.update(samples['counts'])
+            self.events.extend(samples['events'])
+
+    def summary(self):
+        with self.lock:
+            spans = {}
+            for name, seconds in sorted(self.spans.items()):
+                seconds = np.array(seconds)
+                spans[name] = {
+                    'count': len(seconds),
+                    'total': float(seconds.sum()),
+                    'p50': float(np.percentile(seconds, 50)),
+                    'p95': float(np.percentile(seconds, 95)),
+                    'max': float(seconds.max()),
+                }
+            return {'spans': spans, 'counts': dict(sorted(self.counts.items())), 'events': list(self.events)}
+
+    def write_report(self, filename, **extra):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(dict(self.summary(), **extra), f, indent=2)
+
+# The recorder used throughout the pipeline, one per process.
+recorder = Recorder()
+
+def span(name):
+    return recorder.span(name)
+
+def count(name, n=1):
+    recorder.count(name, n)
+
+"""
+Profile the block with cProfile, saving the stats to filename (which can be
+read with pstats or snakeviz). Does nothing if filename is None.
+Only the calling thread is profiled.
+"""
+@contextmanager
+def profiled(filename):
+    if filename is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(filename)
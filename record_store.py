@@ -0,0 +1,117 @@
+import fcntl
+import hashlib
+import os
+import pickle
+import struct
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+"""
+An append-only, content addressed store of python objects.
+Each record on disk is a 20 byte key digest, the payload length and the pickled
+payload. Opening a store only reads the record headers; payloads are loaded
+lazily when looked up, and the most recently used values are kept in an
+in-process LRU. With no filename the store is just the (bounded) LRU.
+"""
+class RecordStore:
+    header = struct.Struct('<20sI')
+
+    """
+    filename (string): The file backing the store, created if missing.
+    maxsize (int): The max number of values kept in memory.
+    """
+    def __init__(self, filename=None, maxsize=4096):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.lru = OrderedDict()
+        self.locations = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.fd = None
+        self.scanned = 0
+        if filename is not None:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            self._scan()
+
+    """
+    Build a key from the given parts, e.g. a sentence and the model used on it.
+    """
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('\x00'.join(str(part) for part in parts).encode('utf-8')).digest()
+
+    # Index any records appended since the last scan, possibly by another process.
+    def _scan(self):
+        size = os.fstat(self.fd).st_size
+        offset = self.scanned
+        while offset + self.header.size <= size:
+            key, length = self.header.unpack(os.pread(self.fd, self.header.size, offset))
+            if offset + self.header.size + length > size:
+                # Partially written record, it will be picked up by a later scan.
+                break
+            self.locations[key] = (offset + self.header.size, length)
+            offset += self.header.size + length
+        self.scanned = offset
+
+    def _remember(self, key, value):
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def _load(self, key):
+        if key not in self.locations and self.fd is not None:
+            self._scan()
+        if key not in self.locations:
+            return _missing
+        offset, length = self.locations[key]
+        return pickle.loads(os.pread(self.fd, length, offset))
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                return self.lru[key]
+            value = self._load(key)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._remember(key, value)
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.lru or key in self.locations:
+                return True
+            if self.fd is not None:
+                self._scan()
+            return key in self.locations
+
+    def put(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+            if self.fd is None:
+                return
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                offset = os.lseek(self.fd, 0, os.SEEK_END)
+                os.write(self.fd, self.header.pack(key, len(payload)) + payload)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.locations[key] = (offset + self.header.size, len(payload))
+            if self.scanned == offset:
+                self.scanned = offset + self.header.size + len(payload)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
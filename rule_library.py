@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import profiling
+from asp_converter import coref_rules
+
+# Variables of learnt rules (V1, _) and of mode declarations (var(entity)).
+variable = re.compile(r'\bvar\(\w+\)|\b[A-Z_]\w*')
+# Type literals ILASP may add to rule bodies. Every program has the type
+# facts of its arguments, so these never limit which rules match.
+type_signatures = {'entity(_)', 'entity_event(_)', 'event(_)'}
+atom = re.compile(r'^[a-z]\w*(\(.*\))?$')
+
+"""
+The signature of an atom: its name and constants, with every variable
+replaced by _. Learnt rules, mode declarations and ungrounded test
+predicates with the same signature can match each other,
+e.g. property(large, V1) and property(large, var(entity)).
+"""
+def signature(literal):
+    return variable.sub('_', literal.replace(' ', ''))
+
+# Split a rule body on the commas (or semicolons) between its literals.
+def split_literals(body):
+    literals = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(body):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c in ',;' and depth == 0:
+            literals.append(body[start:i])
+            start = i + 1
+    literals.append(body[start:])
+    return [literal.strip() for literal in literals if literal.strip()]
+
+"""
+The signature of the head of the rule (None for a constraint), and the
+signatures of the atoms its body needs to hold. Negated literals,
+comparisons and type literals are not needed.
+"""
+def rule_signatures(rule):
+    head, _, body = rule.rstrip('.').partition(':-')
+    head = signature(head.strip()) if head.strip() else None
+    needed = set()
+    for literal in split_literals(body):
+        if literal.startswith('not ') or not atom.match(literal):
+            continue
+        s = signature(literal)
+        if s not in type_signatures:
+            needed.add(s)
+    return head, needed
+
+# The rules of a hypothesis learnt by ILASP, one per line.
+def parse_rules(hypothesis):
+    rules = []
+    for line in hypothesis.split('\n'):
+        line = line.strip()
+        if line.endswith('.') and not line.startswith('%') and not line.startswith('#'):
+            rules.append(line)
+    return rules
+
+# The signatures of the test predicates, as they appear in mode declarations.
+def predicate_signatures(predicates):
+    args = [arg for p in predicates for arg in p.get_relevant_args()]
+    arg_to_var = {arg_name: f'var({pred_name})' for pred_name, arg_name in args}
+    return set(signature(p.ungrounded(arg_to_var)) for p in predicates)
+
+"""
+Rules learnt by ILASP ahead of time (see learn_rules.py), indexed by the
+signatures of the atoms their bodies need.
+"""
+class RuleLibrary:
+    """
+    rules (dict): Each rule, with its support (the number of learning tasks
+        it was learnt by) and the training examples of those tasks.
+    metadata (dict): How the library was learnt, e.g., the training file.
+    """
+    def __init__(self, rules=None, metadata=None):
+        self.rules = rules or {}
+        self.metadata = metadata or {}
+        self._index()
+
+    def _index(self):
+        self.ordered = sorted(self.rules)
+        self.heads = []
+        self.bodies = []
+        # Rule ids, keyed by each signature their bodies need.
+        self.index = {}
+        # Rules whose bodies need nothing, so always apply.
+        self.unconditional = []
+        for rule_id, rule in enumerate(self.ordered):
+            head, body = rule_signatures(rule)
+            self.heads.append(head)
+            self.bodies.append(body)
+            if not body:
+                self.unconditional.append(rule_id)
+            for s in body:
+                self.index.setdefault(s, []).append(rule_id)
+
+    def __len__(self):
+        return len(self.rules)
+
+    """
+    Add the rules of a hypothesis learnt from the given training examples.
+    The index is rebuilt by reindex, once every hypothesis has been added.
+    """
+    def add(self, hypothesis, examples):
+        for rule in parse_rules(hypothesis):
+            entry = self.rules.setdefault(rule, {'support': 0, 'examples': []})
+            entry['support'] += 1
+            entry['examples'].extend(examples)
+
+    def reindex(self, min_support=1):
+        self.rules = {rule: entry for rule, entry in self.rules.items() if entry['support'] >= min_support}
+        self._index()
+
+    """
+    The rules which can apply to a program with the given signatures: those
+    whose bodies only need atoms with these signatures, or atoms derived by
+    other such rules.
+    """
+    def matching(self, signatures):
+        available = set(signatures)
+        queue = list(available)
+        matched = []
+        # The number of signatures each rule still needs.
+        missing = {rule_id: 0 for rule_id in self.unconditional}
+        ready = list(self.unconditional)
+        while ready or queue:
+            for rule_id in ready:
+                matched.append(rule_id)
+                head = self.heads[rule_id]
+                if head is not None and head not in available:
+                    available.add(head)
+                    queue.append(head)
+            ready = []
+            if queue:
+                for rule_id in self.index.get(queue.pop(), []):
+                    missing[rule_id] = missing.get(rule_id, len(self.bodies[rule_id])) - 1
+                    if missing[rule_id] == 0:
+                        ready.append(rule_id)
+        return [self.ordered[rule_id] for rule_id in sorted(matched)]
+
+    """
+    Write the library to filename, replacing any earlier library only once
+    it has been written in full.
+    """
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        staging = f'{filename}.tmp-{os.getpid()}'
+        with open(staging, 'w') as f:
+            json.dump({'metadata': self.metadata, 'rules': self.rules}, f, indent=1)
+        os.replace(staging, filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as f:
+            library = json.load(f)
+        return RuleLibrary(library['rules'], library['metadata'])
+
+"""
+Build a commonsense program from a library of rules learnt ahead of time,
+so that solving needs clingo, but not ILASP.
+"""
+class RuleLibraryTranslation:
+    """
+    pronoun_symbol (string): The string used to represent the target to be resolved.
+    debug (boolean): If true will save debug info to files.
+    library_filename (string): The library written by learn_rules.py.
+    """
+    def __init__(self, pronoun_symbol, debug=False, cache_dir=None, library_filename='rule_library.json'):
+        self.pronoun_symbol = pronoun_symbol
+        self.debug = debug
+        assert os.path.exists(library_filename), f'No rule library at {library_filename}. Learn one with learn_rules.py.'
+        self.library = RuleLibrary.load(library_filename)
+
+    def build(self, unused_background_knowledge, test, test_predicates, debug_dir='.'):
+        rules = self.library.matching(predicate_signatures(test_predicates))
+        profiling.count('rule_library.rules', len(rules))
+        if not rules:
+            profiling.count('rule_library.no_rules')
+        background = coref_rules(self.pronoun_symbol)
+        # The type facts of the learning tasks, for rules with type literals.
+        entities = sorted(set(f'{pred_name}({arg_name}).' for p in test_predicates for pred_name, arg_name in p.get_relevant_args()))
+        problem_facts = '\n'.join([p.grounded() for p in test_predicates] + entities)
+        program = '\n'.join(background) + '\n' + problem_facts + '\n' + '\n'.join(rules)
+        if self.debug:
+            with open(os.path.join(debug_dir, 'rule-library-program.lp'), 'w') as f:
+                f.write(program)
+        return program
@@ -3,6 +3,7 @@ import spacy
 from spacy import symbols
 #import neuralcoref
 from collections import Counter
+import profiling
 
 class ModelSize(Enum):
     SMALL = 1
@@ -18,15 +19,25 @@ size_to_model_name = {
 dative = spacy.strings.get_string_id('dative')
 compound = spacy.strings.get_string_id('compound')
 
+# Pipeline components whose annotations are never read during extraction.
+unused_components = ['ner']
+
+# Bump when extraction changes, so predicates cached by earlier versions are not reused.
+EXTRACTOR_VERSION = 1
+
 # Translate plain text into it's semantic elements (events and properties)
 class SemanticExtraction:
     def __init__(self, model_size = ModelSize.LARGE, token_replacement={}, use_event_id=True):
         model_name = size_to_model_name[model_size]
-        self.model = spacy.load(model_name)
+        self.model = spacy.load(model_name, disable=unused_components)
         self.token_replacement = token_replacement
         self.counter = Counter()
         self.span_to_id = {}
         self.use_event_id = use_event_id
+        # Parsed docs, keyed by sentence, filled in ahead of time by parse_many.
+        self.docs = {}
+        # Identifies the model, so results from different models are not mixed.
+        self.model_key = f'{self.model.meta["lang"]}_{self.model.meta["name"]}-{self.model.meta["version"]}'
 
     def next_id(self, word):
         self.counter.update([word])
@@ -191,11 +202,37 @@ class SemanticExtraction:
                     properties.append(Property(self._normalise(object), [self._normalise(token)]))
         return properties
 
+    """
+    Parse the given sentences in batches with nlp.pipe, and keep the docs so
+    later calls to extract_all for these sentences skip the model. Each doc
+    is dropped once it has been extracted.
+    Sentences which have already been parsed are not parsed again.
+    """
+    def parse_many(self, sentences, batch_size=256, n_process=1):
+        to_parse = list(dict.fromkeys(s for s in sentences if s not in self.docs))
+        with profiling.span('parse'):
+            docs = self.model.pipe(to_parse, batch_size=batch_size, n_process=n_process)
+            for sentence, doc in zip(to_parse, docs):
+                self.docs[sentence] = doc
+
+    """
+    Extract the predicates of every sentence, parsing them together first.
+    Returns a list of predicate lists, in the same order as sentences.
+    """
+    def extract_many(self, sentences, batch_size=256, n_process=1):
+        sentences = list(sentences)
+        self.parse_many(sentences, batch_size=batch_size, n_process=n_process)
+        return [self.extract_all(sentence) for sentence in sentences]
+
     def extract_all(self, sentence):
-        doc = self.model(sentence)
-        # Reset id tracker.
-        self.span_to_id = {}
-        return self.extract_events(doc) + self.extract_modifiers(doc) + self.extract_properties(doc)
+        with profiling.span('extract'):
+            # Docs are large, so are only kept until they are extracted.
+            doc = self.docs.pop(sentence, None)
+            if doc is None:
+                doc = self.model(sentence)
+            # Reset id tracker.
+            self.span_to_id = {}
+            return self.extract_events(doc) + self.extract_modifiers(doc) + self.extract_properties(doc)
 
 class Predicate:
     def __init__(self, name, args):
@@ -1,16 +1,217 @@
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import hashlib
+import json
 import numpy as np
+import os
+import scipy.sparse
+import shutil
+import tempfile
+import time
+
+# Bump when the saved index format (or the sentences it is built from) changes.
+INDEX_VERSION = 3
+
+"""
+Return the column indices of the k largest similarities in each row, and the
+similarities themselves. As with argpartition, the k are in no particular order.
+"""
+def top_k(similarities, k):
+    # The k smallest elements correspond to the closest sentences as
+    # determined by their cosine similarity.
+    indices = np.argpartition(1 - similarities, k-1, axis=1)[:, :k]
+    return indices, np.take_along_axis(similarities, indices, axis=1)
+
+"""
+Brute force search, comparing the query against every sentence in the corpus.
+The TF-IDF vectors are l2 normalised, so their cosine similarity is just their
+dot product. Queries are compared in chunks of chunk_size, each as one sparse
+matrix product, to bound the memory used by the dense similarity matrix.
+"""
+class ExactIndex:
+    def __init__(self, corpus_vectors, chunk_size=256):
+        self.corpus_vectors = corpus_vectors
+        self.chunk_size = chunk_size
+
+    def search(self, queries, query_vectors, k):
+        indices, scores = [], []
+        for start in range(0, query_vectors.shape[0], self.chunk_size):
+            similarities = (query_vectors[start:start + self.chunk_size] @ self.corpus_vectors.T).toarray()
+            chunk_indices, chunk_scores = top_k(similarities, k)
+            indices.append(chunk_indices)
+            scores.append(chunk_scores)
+        if not indices:
+            return np.empty((0, k), dtype=np.int64), np.empty((0, k))
+        return np.concatenate(indices), np.concatenate(scores)
+
+"""
+Approximate search with random projection locality sensitive hashing.
+Each table hashes a TF-IDF vector to the signs of its projection onto
+num_bits random hyperplanes, so similar sentences tend to share a bucket.
+Only the sentences sharing a bucket with the query in some table are
+compared against it. If there are fewer than k of them, the query falls
+back to exact search.
+"""
+class LshIndex:
+    def __init__(self, corpus_vectors, num_tables=8, num_bits=12, seed=0):
+        random_state = np.random.RandomState(seed)
+        self.corpus_vectors = corpus_vectors
+        self.exact = ExactIndex(corpus_vectors)
+        self.planes = random_state.randn(num_tables, corpus_vectors.shape[1], num_bits).astype(np.float32)
+        self.bit_values = 1 << np.arange(num_bits, dtype=np.int64)
+        # For each table: the sorted bucket codes, where each bucket starts
+        # in members, and the corpus indices ordered by bucket.
+        self.tables = []
+        for planes in self.planes:
+            codes = self._codes(corpus_vectors, planes)
+            members = np.argsort(codes, kind='stable')
+            buckets, starts = np.unique(codes[members], return_index=True)
+            self.tables.append((buckets, np.append(starts, len(members)), members))
+
+    def _codes(self, vectors, planes):
+        return (np.asarray(vectors @ planes) > 0).astype(np.int64) @ self.bit_values
+
+    def _candidates(self, query_vector):
+        candidates = []
+        for planes, (buckets, starts, members) in zip(self.planes, self.tables):
+            code = self._codes(query_vector, planes)[0]
+            bucket = np.searchsorted(buckets, code)
+            if bucket < len(buckets) and buckets[bucket] == code:
+                candidates.append(members[starts[bucket]:starts[bucket + 1]])
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(candidates))
+
+    def search(self, queries, query_vectors, k):
+        indices, scores = [], []
+        for i in range(query_vectors.shape[0]):
+            query_vector = query_vectors[i]
+            candidates = self._candidates(query_vector)
+            if len(candidates) < k:
+                found, similarities = self.exact.search(None, query_vector, k)
+                indices.append(found[0])
+                scores.append(similarities[0])
+                continue
+            found, similarities = top_k((query_vector @ self.corpus_vectors[candidates].T).toarray(), k)
+            indices.append(candidates[found[0]])
+            scores.append(similarities[0])
+        return np.array(indices).reshape(len(indices), k), np.array(scores).reshape(len(scores), k)
+
+"""
+Dense retrieval, comparing the averaged word vectors of the sentences.
+nlp: A loaded spacy model with word vectors (e.g., en_core_web_lg). Only
+its vocabulary is used, none of its pipeline components are run.
+"""
+class DenseIndex:
+    def __init__(self, corpus, nlp):
+        self.nlp = nlp
+        self.corpus_vectors = self._embed(corpus)
+
+    def _embed(self, sentences):
+        docs = self.nlp.pipe(sentences, disable=self.nlp.pipe_names)
+        vectors = np.array([doc.vector for doc in docs], dtype=np.float32).reshape(-1, self.nlp.vocab.vectors_length)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def search(self, queries, query_vectors, k):
+        return top_k(self._embed(queries) @ self.corpus_vectors.T, k)
+
+retrieval_backends = ['exact', 'lsh', 'dense']
+
+# The sha1 of a file's contents, e.g. to check a saved model was fitted on it.
+def file_digest(filename, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 class SentenceFinder:
-    def __init__(self, corpus, k = 1):
-        vectorizer = TfidfVectorizer()
-        self.tf_idf_model = vectorizer.fit(corpus)
+    """
+    corpus: The sentences to search, any iterable. It is streamed through once
+        while fitting, and not kept, so a result is an index into the corpus.
+    k: The number of sentences returned for each query.
+    backend: How to search the corpus, one of {exact, lsh, dense}.
+    nlp: The spacy model providing word vectors, only used by the dense backend.
+    """
+    def __init__(self, corpus, k = 1, backend='exact', nlp=None):
+        if backend == 'dense':
+            # Embedding needs a second pass over the sentences.
+            corpus = list(corpus)
+        self.tf_idf_model = TfidfVectorizer()
         # This is an sklearn sparse array, NOT a numpy array.
-        self.corpus_vectors = self.tf_idf_model.transform(corpus)
-        # Note: It is easier to work with a numpy array for text (e.g., for np indexing).
-        self.corpus = np.array(corpus)
+        self.corpus_vectors = self.tf_idf_model.fit_transform(corpus)
+        self._create_index(k, backend, nlp, corpus)
+
+    def _create_index(self, k, backend, nlp, corpus):
+        assert backend in retrieval_backends, f'Unknown retrieval backend specified. Choose one of {retrieval_backends}'
         self.k = k
+        self.backend = backend
+        if backend == 'lsh':
+            self.index = LshIndex(self.corpus_vectors)
+        elif backend == 'dense':
+            assert nlp is not None, 'The dense backend needs a spacy model with word vectors.'
+            assert corpus is not None, 'The dense backend needs the corpus sentences.'
+            self.index = DenseIndex(corpus, nlp)
+        else:
+            self.index = ExactIndex(self.corpus_vectors)
+
+    """
+    Save the fitted model to directory: the vocabulary, the idf weights, the
+    corpus vectors as the three arrays of a CSR matrix.
+    digest identifies the data the model was fitted on (e.g., a hash of the
+    training file), and is checked by load.
+    """
+    def save(self, directory, digest):
+        # Save into a staging directory which is renamed into place, so that a
+        # partially saved model is never loaded, even by another process.
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=parent)
+        save = lambda name, value: np.save(os.path.join(staging, f'{name}.npy'), value)
+        vectors = self.corpus_vectors.tocsr()
+        save('idf', self.tf_idf_model.idf_)
+        save('data', vectors.data)
+        save('indices', vectors.indices)
+        save('indptr', vectors.indptr)
+        vocabulary = {term: int(i) for term, i in self.tf_idf_model.vocabulary_.items()}
+        with open(os.path.join(staging, 'vocabulary.json'), 'w') as f:
+            json.dump(vocabulary, f)
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'digest': digest, 'shape': list(vectors.shape)}, f)
+        if os.path.isdir(directory) and SentenceFinder.load(directory, digest) is None:
+            # An out of date model.
+            shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            # Another process saved the model first.
+            shutil.rmtree(staging, ignore_errors=True)
+
+    """
+    Load a model saved in directory, or return None if there is none or it
+    was fitted on different data (its digest does not match). The corpus
+    vectors are memory-mapped rather than read. The dense backend also needs
+    the corpus sentences, as they are embedded again.
+    """
+    @staticmethod
+    def load(directory, digest, k=1, backend='exact', nlp=None, corpus=None):
+        meta_filename = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_filename):
+            return None
+        with open(meta_filename, 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_VERSION or meta['digest'] != digest:
+            return None
+        load = lambda name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        vectorizer = TfidfVectorizer()
+        with open(os.path.join(directory, 'vocabulary.json'), 'r') as f:
+            vectorizer.vocabulary_ = json.load(f)
+        vectorizer.idf_ = np.array(load('idf'))
+        finder = SentenceFinder.__new__(SentenceFinder)
+        finder.tf_idf_model = vectorizer
+        finder.corpus_vectors = scipy.sparse.csr_matrix((load('data'), load('indices'), load('indptr')), shape=tuple(meta['shape']), copy=False)
+        finder._create_index(k, backend, nlp, corpus)
+        return finder
 
     """
     Given the query, return the sentences
@@ -19,8 +220,39 @@ class SentenceFinder:
     def get(self, query):
         query_vector = self.tf_idf_model.transform([query])
         assert query_vector.shape[0] == 1, f'Transformed query should have one vector, instead has {query_vector.shape[0]}!'
-        similarities = 1 - cosine_similarity(query_vector, self.corpus_vectors)
-        # The k smallest elements correspond to the closest sentences as
-        # determined by their cosine similarity.
-        indices = np.argpartition(similarities, self.k-1)[0][:self.k]
-        return indices.tolist()
+        return self.index.search([query], query_vector, self.k)[0][0].tolist()
+
+    """
+    Find the similar sentences of many queries at once, transforming them
+    together. Returns the indices of the k closest sentences for each query,
+    and their similarity scores, each as an array with a row per query.
+    """
+    def get_many(self, queries):
+        queries = list(queries)
+        query_vectors = self.tf_idf_model.transform(queries)
+        return self.index.search(queries, query_vectors, self.k)
+
+    """
+    Measure how well this finder agrees with exact TF-IDF search on the given
+    queries. Returns the mean recall@k against exact search, and the mean
+    seconds per query of both.
+    """
+    def evaluate(self, queries):
+        exact = self.index if self.backend == 'exact' else ExactIndex(self.corpus_vectors)
+        recalls, seconds, exact_seconds = [], 0.0, 0.0
+        for query in queries:
+            query_vector = self.tf_idf_model.transform([query])
+            start = time.perf_counter()
+            found = self.index.search([query], query_vector, self.k)[0][0]
+            seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            expected = exact.search([query], query_vector, self.k)[0][0]
+            exact_seconds += time.perf_counter() - start
+            recalls.append(len(set(found.tolist()) & set(expected.tolist())) / self.k)
+        num_queries = max(len(queries), 1)
+        return {
+            'backend': self.backend,
+            'recall_at_k': float(np.mean(recalls)) if recalls else 0.0,
+            'seconds_per_query': seconds / num_queries,
+            'exact_seconds_per_query': exact_seconds / num_queries,
+        }
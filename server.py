@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from main import ANSWER, CANDIDATE_1, CANDIDATE_2, SENTENCE, add_solver_arguments, create_solver, get_prediction, start_ilasp_budget
+
+ID = 'qID'
+
+"""
+A long lived solver, answering WSC problems sent as JSON lines. The solver,
+and every model and index it uses, is loaded once at startup, so a request
+only waits for its own solve.
+Each request is a JSON object with the sentence, option1 and option2 of a
+problem (and optionally its qID). Each response is a JSON object with the
+qID, the prediction (1 or 2, or 0 if unknown), the answer, the
+additional_info returned by Solver.solve, and the seconds taken to solve.
+Requests are solved concurrently by up to workers threads, so responses are
+written as they are finished and may be out of order; use the qID to match
+them up.
+"""
+class SolverServer:
+    def __init__(self, solver, workers=4):
+        self.solver = solver
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+
+    def _next_id(self):
+        with self.lock:
+            self.num_requests += 1
+            return f'request-{self.num_requests}'
+
+    def solve(self, line):
+        try:
+            request = json.loads(line)
+            test_example = {
+                SENTENCE: request[SENTENCE],
+                CANDIDATE_1: request[CANDIDATE_1],
+                CANDIDATE_2: request[CANDIDATE_2],
+                # The answer only orders the candidates, it is not used to solve.
+                ANSWER: request.get(ANSWER) or 1,
+                ID: request.get(ID) or self._next_id(),
+            }
+        except (ValueError, KeyError, TypeError) as e:
+            return {'error': f'Invalid request: {e}'}
+        start = time.perf_counter()
+        try:
+            answer, additional_info = self.solver.solve(test_example)
+        except Exception as e:
+            return {ID: test_example[ID], 'error': str(e)}
+        return {
+            ID: test_example[ID],
+            'prediction': get_prediction(answer, test_example),
+            'answer': answer,
+            'additional_info': additional_info,
+            'seconds': time.perf_counter() - start,
+        }
+
+    """
+    Solve every request read from lines, writing each response with write.
+    Returns once all of them have been answered.
+    """
+    def serve_lines(self, lines, write):
+        write_lock = threading.Lock()
+        def respond(future):
+            response = json.dumps(future.result()) + '\n'
+            with write_lock:
+                write(response)
+        futures = []
+        for line in lines:
+            if not line.strip():
+                continue
+            future = self.executor.submit(self.solve, line)
+            future.add_done_callback(respond)
+            futures.append(future)
+        wait(futures)
+
+    def serve_stdin(self):
+        out = sys.stdout
+        # The solver prints progress and warnings, which must not be mixed
+        # into the responses.
+        sys.stdout = sys.stderr
+        def write(response):
+            out.write(response)
+            out.flush()
+        self.serve_lines(sys.stdin, write)
+
+    """
+    Accept connections on a unix socket at path, each sending requests and
+    receiving responses as JSON lines.
+    """
+    def serve_unix(self, path):
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def write(response):
+                    self.wfile.write(response.encode('utf-8'))
+                    self.wfile.flush()
+                server.serve_lines((line.decode('utf-8') for line in self.rfile), write)
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+            print(f'Listening on {path}', file=sys.stderr)
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.remove(path)
+
+    def close(self):
+        self.executor.shutdown()
+
+def main(args):
+    # A budget given for the ILASP tasks covers the lifetime of the server.
+    start_ilasp_budget(args)
+    solver = create_solver(args.train_path, args)
+    server = SolverServer(solver, workers=args.workers)
+    try:
+        if args.socket:
+            server.serve_unix(args.socket)
+        else:
+            server.serve_stdin()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a WSC solver, answering problems sent as JSON lines.')
+    add_solver_arguments(parser)
+    parser.add_argument(
+        '--socket',
+        default=None,
+        help='The path of a unix socket to listen on. Requests are read from stdin if not given.')
+    parser.add_argument(
+        '--workers',
+        default=4,
+        type=int,
+        help='The number of requests solved concurrently.')
+    main(parser.parse_args())
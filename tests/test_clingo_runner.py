@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip('clyngor')
+clingo = pytest.importorskip('clingo')
+from clingo_runner import AspRunner
+
+PRONOUN = 'target_pronoun'
+# The rules of asp_converter.coref_rules, which needs spacy to import.
+BASE_RULES = [
+    f'coref({PRONOUN}, Y) :- property(P, {PRONOUN}), property(P, Y), Y != {PRONOUN}.',
+    f'coref({PRONOUN}, Y) :- event_subject(E, {PRONOUN}), event_subject(E, Y), Y != {PRONOUN}.',
+    f'coref({PRONOUN}, Y) :- event_object(E, {PRONOUN}), event_object(E, Y), Y != {PRONOUN}.',
+]
+# Programs repeating facts of earlier programs, with answers that differ.
+PROGRAMS = [
+    'property(large, target_pronoun).\nproperty(large, trophy).\nproperty(small, suitcase).',
+    'property(small, target_pronoun).\nproperty(large, trophy).\nproperty(small, suitcase).',
+    'property(large, target_pronoun).\nproperty(large, trophy).\nproperty(small, suitcase).',
+    'event_subject(fit_1, target_pronoun).\nevent_subject(fit_1, trophy).\nproperty(large, trophy).',
+    'property(huge, target_pronoun).\nproperty(big, V1) :- property(huge, V1).\nproperty(big, suitcase).',
+    ':- property(large, trophy).\nproperty(large, trophy).',
+    # Strong negation, as in the Antonym rules of ConceptNetTranslation: inconsistent, so UNSAT.
+    'property(large, target_pronoun).\nproperty(large, trophy).\n-property(large, Y) :- property(small, Y).\nproperty(small, trophy).',
+    'property(small, target_pronoun).\nproperty(small, suitcase).\n-property(large, Y) :- property(small, Y).\nproperty(large, trophy).',
+    'property(small, target_pronoun).\nproperty(large, trophy).\nproperty(small, suitcase).',
+]
+
+def test_multi_shot_matches_single_shot():
+    multi_shot = AspRunner(backend='clingo', base_rules=BASE_RULES)
+    single_shot = AspRunner(backend='clingo')
+    for program in PROGRAMS * 2:
+        program = '\n'.join(BASE_RULES) + '\n' + program
+        assert multi_shot.run(program) == single_shot.run(program), program
+
+def test_multi_shot_replaces_control_after_max_steps():
+    multi_shot = AspRunner(backend='clingo', base_rules=BASE_RULES)
+    multi_shot.max_steps = 2
+    for program in PROGRAMS:
+        assert multi_shot.run('\n'.join(BASE_RULES) + '\n' + program) == AspRunner(backend='clingo').run(program + '\n' + '\n'.join(BASE_RULES))
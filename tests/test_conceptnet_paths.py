@@ -0,0 +1,87 @@
+import json
+import random
+import pytest
+
+pytest.importorskip('spacy')
+from asp_converter import ConceptNetTranslation
+from conceptnet_store import ConceptNetStore, LandmarkIndex, build, build_landmarks
+
+RELATIONS = ['RelatedTo', 'IsA', 'Antonym', 'UsedFor', 'CapableOf']
+
+# A random crawl of the given number of words, of which the first crawled
+# are crawled, so the rest are only at the end of edges.
+def write_crawl(directory, nodes=300, crawled=250, seed=0):
+    random_state = random.Random(seed)
+    words = [f'word{i}' for i in range(nodes)]
+    locations = {}
+    with open(directory / 'db.jsonl', 'w') as f:
+        for line_number, word in enumerate(words[:crawled]):
+            edges = [
+                {'name': random_state.choice(words), 'relation': random_state.choice(RELATIONS), 'weight': 1.0}
+                for _ in range(random_state.randint(2, 5))]
+            f.write(json.dumps({word: edges}) + '\n')
+            locations[word] = line_number
+    with open(directory / 'node_locations.json', 'w') as f:
+        json.dump(locations, f)
+    return words
+
+def open_store(directory):
+    build(str(directory / 'db.jsonl'), str(directory / 'node_locations.json'), str(directory / 'graph'), pos_model=None)
+    return ConceptNetStore(str(directory / 'graph'))
+
+def translation(store, landmarks, max_depth):
+    # Built without __init__, which opens the default store.
+    conceptnet = ConceptNetTranslation.__new__(ConceptNetTranslation)
+    conceptnet.store = store
+    conceptnet.landmarks = landmarks
+    conceptnet.max_depth = max_depth
+    conceptnet.max_expansions = None
+    return conceptnet
+
+# A forward breadth first search from start to goal alone, as the search per pair was.
+def single_pair_path(store, start, goal, max_depth):
+    start_id, goal_id = store.node_id(start), store.node_id(goal)
+    if start == goal or start_id is None or goal_id is None:
+        return None
+    parents = {start_id: None}
+    frontier = [start_id]
+    depth = 0
+    while frontier and goal_id not in parents:
+        if max_depth is not None and depth >= max_depth:
+            return None
+        next_frontier = []
+        for node in frontier:
+            neighbors, relations, _ = store.edges(node)
+            for next_node, relation in zip(neighbors.tolist(), relations.tolist()):
+                if next_node in parents: continue
+                parents[next_node] = (node, relation)
+                next_frontier.append(next_node)
+        frontier = next_frontier
+        depth += 1
+    if goal_id not in parents:
+        return None
+    path = []
+    node = goal_id
+    while parents[node] is not None:
+        previous, relation = parents[node]
+        path.append((store.name(previous), store.relations[relation], store.name(node)))
+        node = previous
+    return path[::-1]
+
+@pytest.mark.parametrize('use_landmarks', [False, True])
+@pytest.mark.parametrize('max_depth', [None, 2, 4])
+def test_find_paths_matches_single_pair_search(tmp_path, use_landmarks, max_depth):
+    words = write_crawl(tmp_path)
+    store = open_store(tmp_path)
+    landmarks = None
+    if use_landmarks:
+        build_landmarks(store, range(len(store)), count=4, directory=str(tmp_path / 'landmarks'))
+        landmarks = LandmarkIndex.open(store, str(tmp_path / 'landmarks'))
+    conceptnet = translation(store, landmarks, max_depth)
+    random_state = random.Random(1)
+    for _ in range(150):
+        start = random_state.choice(words)
+        goals = random_state.sample(words, 3) + ['missing', start]
+        paths = conceptnet.find_paths(start, goals)
+        for goal in goals:
+            assert paths.get(goal) == single_pair_path(store, start, goal, max_depth), (start, goal)
@@ -1,9 +1,19 @@
+from array import array
+from collections import OrderedDict
+import json
 import jsonlines
-from sentence_finder import SentenceFinder
-from semantic_extraction import ModelSize, SemanticExtraction
-from asp_converter import IlaspBuilder, ConceptNetTranslation
+import numpy as np
+import os
+from record_store import RecordStore
+from sentence_finder import SentenceFinder, file_digest
+from semantic_extraction import EXTRACTOR_VERSION, ModelSize, SemanticExtraction
+from asp_converter import IlaspBuilder, ConceptNetTranslation, IlaspCancelled, coref_rules
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import re
 from clingo_runner import AspRunner
+from rule_library import RuleLibraryTranslation
+import profiling
 import spacy
 from statistics import mean
 import traceback
@@ -20,7 +30,10 @@ token_replacement_map = {
 models = {
     'ILASPTranslation': IlaspBuilder,
     'ConceptNetTranslation': ConceptNetTranslation,
+    'RuleLibraryTranslation': RuleLibraryTranslation,
 }
+# Models which solve the test sentence alone, without similar training examples.
+models_without_background = ['ConceptNetTranslation', 'RuleLibraryTranslation']
 
 
 """
@@ -31,37 +44,130 @@ class Solver:
     """
     corpus_filename: Path to training file in jsonl format.
     num_examples_per_input: Hyperparameter to determine the max number of training examples to use per input.
+    cache_dir: Directory to persist extracted predicates (and other results) between runs. Nothing is persisted if None.
+    debug_root: Directory holding a debug directory for each solved example, used if debug is set.
+    multi_shot: If true, the rules shared by every program are kept in one persistent clingo control.
+    retrieval: How similar training examples are found, one of {exact, lsh, dense}.
+    ilasp_scheduler: Runs the ILASP tasks of ILASPTranslation, with its timeouts and resource limits.
+    rule_library: The rules learnt ahead of time by learn_rules.py, used by RuleLibraryTranslation.
+    conceptnet_max_depth: The longest ConceptNet path ConceptNetTranslation searches for. Unbounded if None.
+    conceptnet_max_expansions: The max number of nodes expanded by one ConceptNet path search. Unbounded if None.
     """
-    def __init__(self, corpus_filename, num_examples_per_input=1, model_size=ModelSize.LARGE, debug=False, model_name='DirectTranslation', mode='iterative'):
-        self.corpus = self._load_corpus(corpus_filename)
-        sentences = [example.get_masked_sentence() for example in self.corpus]
-        self.sentence_finder = SentenceFinder(sentences, k=num_examples_per_input)
+    def __init__(self, corpus_filename, num_examples_per_input=1, model_size=ModelSize.LARGE, debug=False, model_name='DirectTranslation', mode='iterative', cache_dir=None, debug_root='debug', multi_shot=False, retrieval='exact', ilasp_scheduler=None, rule_library='rule_library.json', conceptnet_max_depth=None, conceptnet_max_expansions=None):
+        self.corpus = CorpusStore(corpus_filename)
         use_event_id = True if model_name == 'ConceptNetTranslation' else True
         self.semantic_extractor = SemanticExtraction(model_size = model_size, token_replacement=token_replacement_map, use_event_id=use_event_id)
+        # The dense backend reuses the word vectors of the parsing model.
+        nlp = self.semantic_extractor.model if retrieval == 'dense' else None
+        self.sentence_finder = self._create_sentence_finder(corpus_filename, cache_dir, num_examples_per_input, retrieval, nlp)
+        # The indices of the similar training examples, keyed by masked test sentence.
+        self.neighbours = {}
+        self.cache_dir = cache_dir
+        predicates_filename = os.path.join(cache_dir, 'predicates.bin') if cache_dir else None
+        self.predicate_store = RecordStore(predicates_filename)
+        # The semantic extractor keeps state while extracting, so only one
+        # thread may use it at a time (e.g., in server.py).
+        self.extraction_lock = threading.Lock()
         self.debug = debug
-        self.program_runner = AspRunner()
-        self.times = []
-        self.no_path = 0
-        self.no_words = 0
-        self.errors = 0
-        assert mode in ['batch', 'iterative'], 'Unkown mode specified. Choose one of {batch, iterative}'
+        self.debug_root = debug_root
+        self.num_solved = 0
+        self.program_runner = AspRunner(base_rules=coref_rules(SEMANTIC_PRONOUN_SYMBOL) if multi_shot else None)
+        assert mode in ['batch', 'iterative', 'speculative'], 'Unkown mode specified. Choose one of {batch, iterative, speculative}'
         self.mode = mode
         assert model_name in models, f'Unknown model specified. Choose one of {models.keys()}'
         self.model_name = model_name
-        self.program_builder = models[model_name](SEMANTIC_PRONOUN_SYMBOL, debug=debug)
-
-    def _load_corpus(self, filename):
-        data = []
-        with jsonlines.open(filename) as reader:
-            for line in reader:
-                data.append(WSCProblem(
-                    line[SENTENCE],
-                    line[CANDIDATE_1],
-                    line[CANDIDATE_2],
-                    line[ANSWER]))
-        return data
-
-    def batch_solve(self, test_example, test_predicates):
+        builder_args = {}
+        if model_name == 'ILASPTranslation':
+            builder_args = {'scheduler': ilasp_scheduler}
+        elif model_name == 'RuleLibraryTranslation':
+            builder_args = {'library_filename': rule_library}
+        elif model_name == 'ConceptNetTranslation':
+            builder_args = {'max_depth': conceptnet_max_depth, 'max_expansions': conceptnet_max_expansions}
+        self.program_builder = models[model_name](SEMANTIC_PRONOUN_SYMBOL, debug=debug, cache_dir=cache_dir, **builder_args)
+
+    """
+    Load the sentence finder fitted on this training file from the cache, or
+    fit it (and save it to the cache) if the file has changed.
+    """
+    def _create_sentence_finder(self, corpus_filename, cache_dir, k, retrieval, nlp):
+        directory = None
+        if cache_dir:
+            digest = file_digest(corpus_filename)
+            directory = os.path.join(cache_dir, 'sentence_finder', digest)
+            sentence_finder = SentenceFinder.load(directory, digest, k=k, backend=retrieval, nlp=nlp, corpus=self.corpus.masked_sentences())
+            if sentence_finder is not None:
+                return sentence_finder
+        sentence_finder = SentenceFinder(self.corpus.masked_sentences(), k=k, backend=retrieval, nlp=nlp)
+        if directory is not None:
+            sentence_finder.save(directory, digest)
+        return sentence_finder
+
+    """
+    Parse every test sentence, and the training sentences that will be
+    retrieved as their background, in batches before solving starts.
+    test_examples: The test examples in jsonl (dict) format.
+    """
+    def prepare(self, test_examples, batch_size=256, n_process=1):
+        test_examples = [self._to_problem(test_example) for test_example in test_examples]
+        sentences = [test_example.get_sentence() for test_example in test_examples]
+        if self.model_name not in models_without_background:
+            self.find_neighbours([test_example.get_masked_sentence() for test_example in test_examples])
+            for test_example in test_examples:
+                for sentence_idx in self.similar_sentences(test_example):
+                    sentence = self.corpus[sentence_idx].get_sentence()
+                    # Background predicates that are already stored never need parsing.
+                    if self._predicate_key(sentence) not in self.predicate_store:
+                        sentences.append(sentence)
+        self.semantic_extractor.parse_many(sentences, batch_size=batch_size, n_process=n_process)
+
+    """
+    Find the similar training examples of all the given masked sentences in
+    one batch, skipping those which have been found before.
+    """
+    def find_neighbours(self, masked_sentences):
+        queries = list(dict.fromkeys(s for s in masked_sentences if s not in self.neighbours))
+        if not queries:
+            return
+        with profiling.span('retrieval'):
+            indices, _ = self.sentence_finder.get_many(queries)
+        for query, row in zip(queries, indices):
+            self.neighbours[query] = row.tolist()
+
+    def similar_sentences(self, test_example):
+        masked_sentence = test_example.get_masked_sentence()
+        if masked_sentence not in self.neighbours:
+            self.find_neighbours([masked_sentence])
+        return self.neighbours[masked_sentence]
+
+    def _predicate_key(self, sentence):
+        return RecordStore.key(sentence, self.semantic_extractor.model_key, self.semantic_extractor.use_event_id, EXTRACTOR_VERSION)
+
+    """
+    Return the predicates of a training example, from the predicate store if
+    they have been extracted before.
+    """
+    def get_predicates(self, example):
+        sentence = example.get_sentence()
+        key = self._predicate_key(sentence)
+        predicates = self.predicate_store.get(key)
+        if predicates is None:
+            with self.extraction_lock:
+                predicates = self.semantic_extractor.extract_all(sentence)
+            self.predicate_store.put(key, predicates)
+        return predicates
+
+    """
+    Return a new directory for the debug files of one attempt at solving a
+    request, or None if not debugging.
+    """
+    def get_debug_dir(self, request_id, attempt=0):
+        if not self.debug:
+            return None
+        debug_dir = os.path.join(self.debug_root, request_id, str(attempt))
+        os.makedirs(debug_dir, exist_ok=True)
+        return debug_dir
+
+    def batch_solve(self, test_example, test_predicates, request_id):
         answer_found = False
         answer = []
         program = ''
@@ -69,26 +175,51 @@ class Solver:
         background = []
         for sentence_idx in similar_sentences:
             example = self.corpus[sentence_idx]
-            predicates = self.semantic_extractor.extract_all(example.get_sentence())
+            predicates = self.get_predicates(example)
             background.append((example, predicates))
-        answer_found, answer, program = self.build_and_run(background, test_example, test_predicates)
+        answer_found, answer, program = self.build_and_run(background, test_example, test_predicates, self.get_debug_dir(request_id))
         return answer_found, answer, program
 
-    def iterative_solve(self, test_example, test_predicates):
+    def iterative_solve(self, test_example, test_predicates, request_id):
         answer_found = False
         answer = []
         program = ''
         similar_sentences = self.get_background(test_example)
-        for sentence_idx in similar_sentences:
+        for attempt, sentence_idx in enumerate(similar_sentences):
             example = self.corpus[sentence_idx]
-            predicates = self.semantic_extractor.extract_all(example.get_sentence())
-            answer_found, answer, program = self.build_and_run([(example, predicates)], test_example, test_predicates)
+            predicates = self.get_predicates(example)
+            debug_dir = self.get_debug_dir(request_id, attempt)
+            answer_found, answer, program = self.build_and_run([(example, predicates)], test_example, test_predicates, debug_dir)
             if answer_found:
                 return answer_found, answer, program
         return answer_found, answer, program
 
+    """
+    Gives the same answer as iterative_solve, but learns from all the similar
+    sentences at once, each in its own ILASP process. The highest ranked attempt
+    which finds an answer is used, and the remaining attempts are cancelled.
+    """
+    def speculative_solve(self, test_example, test_predicates, request_id):
+        similar_sentences = self.get_background(test_example)
+        # Predicates are extracted before starting, as the extractor is not thread safe.
+        background = [(self.corpus[i], self.get_predicates(self.corpus[i])) for i in similar_sentences]
+        result = (False, [], '')
+        cancel = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(len(background), 1)) as executor:
+            try:
+                attempts = [
+                    executor.submit(self.build_and_run, [example], test_example, test_predicates, self.get_debug_dir(request_id, attempt), cancel)
+                    for attempt, example in enumerate(background)]
+                for attempt in attempts:
+                    result = attempt.result()
+                    if result[0]:
+                        break
+            finally:
+                cancel.set()
+        return result
+
     def get_background(self, test_example):
-        similar_sentences = self.sentence_finder.get(test_example.get_masked_sentence())
+        similar_sentences = self.similar_sentences(test_example)
         if self.debug:
             print(f'Solving: {test_example.sentence}')
             for sentence_idx in similar_sentences:
@@ -100,55 +231,167 @@ class Solver:
     def has_word(self, word, sentence):
         return word in sentence
 
-    def build_and_run(self, background, test_example, test_predicates):
+    def build_and_run(self, background, test_example, test_predicates, debug_dir=None, cancel=None):
         answer = []
         program = ''
+        build_args = {'debug_dir': debug_dir or '.'}
+        if cancel is not None:
+            build_args['cancel'] = cancel
         try:
-            program  = self.program_builder.build(background, test_example, test_predicates)
-            members = self.program_runner.run(program)
+            with profiling.span('build'):
+                program  = self.program_builder.build(background, test_example, test_predicates, **build_args)
+            members = self.program_runner.run(program, debug_dir=debug_dir)
             members = [' '.join(m.split('_')) for m in members]
             answer = []
             for member in members:
                 if self.has_word(member, test_example.get_correct_candidate()) or self.has_word(member, test_example.get_incorrect_candidate()):
                     answer.append(member)
+        except IlaspCancelled:
+            # Another attempt already found the answer.
+            pass
         except Exception as e: # TODO: Don't use a blanket catch.
+            profiling.count('solve.error')
             print(f'WARNING: Aborting {test_example.sentence} -> {background}, \n due to Error: {e}')
             traceback.print_exc()
         return len(answer) == 1, answer, program
 
-    def solve_with_no_background(self, test_example, test_predicates):
-            return self.build_and_run([], test_example, test_predicates)
+    def solve_with_no_background(self, test_example, test_predicates, request_id):
+            return self.build_and_run([], test_example, test_predicates, self.get_debug_dir(request_id))
 
-    def solve(self, test_example):
-        test_example = WSCProblem(
+    def _to_problem(self, test_example):
+        return WSCProblem(
             test_example[SENTENCE],
             test_example[CANDIDATE_1],
             test_example[CANDIDATE_2],
             test_example[ANSWER])
-        test_predicates = self.semantic_extractor.extract_all(test_example.get_sentence())
-        if self.model_name == 'ConceptNetTranslation':
-            answer_found, answer, program = self.solve_with_no_background(test_example, test_predicates)
+
+    # An id for the request, used to keep its debug files apart from others.
+    def _request_id(self, test_example):
+        self.num_solved += 1
+        request_id = test_example.get('qID') or f'{os.getpid()}-{self.num_solved}'
+        return re.sub(r'[^\w.-]', '_', request_id)
+
+    def solve(self, test_example):
+        with profiling.span('solve'):
+            answer, additional_info = self._solve(test_example)
+        profiling.count('solve.unknown' if answer is None else 'solve.answered')
+        return answer, additional_info
+
+    def _solve(self, test_example):
+        request_id = self._request_id(test_example)
+        test_example = self._to_problem(test_example)
+        with self.extraction_lock:
+            test_predicates = self.semantic_extractor.extract_all(test_example.get_sentence())
+        if self.model_name in models_without_background:
+            answer_found, answer, program = self.solve_with_no_background(test_example, test_predicates, request_id)
         else:
             if self.mode == 'batch':
-                answer_found, answer, program = self.batch_solve(test_example, test_predicates)
+                answer_found, answer, program = self.batch_solve(test_example, test_predicates, request_id)
+            elif self.mode == 'speculative':
+                answer_found, answer, program = self.speculative_solve(test_example, test_predicates, request_id)
             else:
-                answer_found, answer, program = self.iterative_solve(test_example, test_predicates)
+                answer_found, answer, program = self.iterative_solve(test_example, test_predicates, request_id)
         if not answer_found:
             return None, None
         # Get background knowledge used for analysis.
-        similar_sentences = self.get_background(test_example)
+        similar_sentences = self.similar_sentences(test_example)
         return (answer[0], {
             'sentence': test_example.get_masked_sentence(),
             'similar_sentences': [self.corpus[i].get_masked_sentence() for i in similar_sentences],
             'program': program
         })
 
+"""
+The training examples of a jsonl file, loaded on demand. Only the byte offset
+of each line is kept in memory, along with the most recently used examples,
+so memory stays flat however large the file is.
+"""
+class CorpusStore:
+    """
+    filename: Path to the jsonl file.
+    maxsize: The max number of examples kept in memory.
+    """
+    def __init__(self, filename, maxsize=1024):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        offsets = array('q')
+        with open(filename, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        offsets.append(offset)
+        # The end of example i is the start of example i + 1 (or the end of the file).
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.fd = os.open(filename, os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        if not 0 <= i < len(self):
+            raise IndexError(f'Example {i} is out of range for a corpus of size {len(self)}.')
+        with self.lock:
+            if i in self.lru:
+                self.lru.move_to_end(i)
+                return self.lru[i]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        example = self._to_problem(json.loads(os.pread(self.fd, end - start, start)))
+        with self.lock:
+            self.lru[i] = example
+            if len(self.lru) > self.maxsize:
+                self.lru.popitem(last=False)
+        return example
+
+    # Stream through the file, without keeping the examples.
+    def __iter__(self):
+        with jsonlines.open(self.filename) as reader:
+            for line in reader.iter(skip_empty=True):
+                yield self._to_problem(line)
+
+    def masked_sentences(self):
+        return (example.get_masked_sentence() for example in self)
+
+    def _to_problem(self, line):
+        return WSCProblem(
+            line[SENTENCE],
+            line[CANDIDATE_1],
+            line[CANDIDATE_2],
+            line[ANSWER])
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# The blank in a WSC sentence, where the target pronoun goes.
+blank = re.compile('_')
+
+"""
+An immutable WSC problem. The masked forms of the sentence are computed once,
+when first needed.
+"""
 class WSCProblem:
+    __slots__ = ('sentence', 'candidate_1', 'candidate_2', 'answer', '_sentence', '_masked_sentence')
+
     def __init__(self, sentence, candidate_1, candidate_2, answer):
-        self.sentence = sentence
-        self.candidate_1 = candidate_1
-        self.candidate_2 = candidate_2
-        self.answer = int(answer)
+        set_field = lambda name, value: object.__setattr__(self, name, value)
+        set_field('sentence', sentence)
+        set_field('candidate_1', candidate_1)
+        set_field('candidate_2', candidate_2)
+        set_field('answer', int(answer))
+        set_field('_sentence', None)
+        set_field('_masked_sentence', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'WSCProblem is immutable, cannot set {name}.')
+
+    def __reduce__(self):
+        return (WSCProblem, (self.sentence, self.candidate_1, self.candidate_2, self.answer))
 
     def __repr__(self):
         return f'{self.sentence} \n CANDIDATE_1: {self.candidate_1} \n' \
@@ -159,25 +402,28 @@ class WSCProblem:
     and any simple coreferences resolved.
     '''
     def get_sentence(self):
-        # Replace the underscore before the candidates, as masking candidates
-        # will possibly reintroduce underscores.
-        mask = re.compile('_')
-        sentence = mask.sub(PRONOUN_SYMBOL, self.sentence)
-        sentence = self._mask_candidate(sentence, self.candidate_1)
-        sentence = self._mask_candidate(sentence, self.candidate_2)
-        return sentence
+        if self._sentence is None:
+            # Replace the underscore before the candidates, as masking candidates
+            # will possibly reintroduce underscores.
+            sentence = blank.sub(PRONOUN_SYMBOL, self.sentence)
+            sentence = self._mask_candidate(sentence, self.candidate_1)
+            sentence = self._mask_candidate(sentence, self.candidate_2)
+            object.__setattr__(self, '_sentence', sentence)
+        return self._sentence
 
     def _mask_candidate(self, sentence, c):
         stopwords = []
         words_in_c = c.split(' ')
         c = [word for word in words_in_c if word not in stopwords]
-        mask = re.compile(' '.join(c))
+        mask = re.compile(re.escape(' '.join(c)))
         return mask.sub('_'.join(c), sentence)
 
     def get_masked_sentence(self):
-        mask = re.compile(f'{self.candidate_1}|{self.candidate_2}')
-        candidate_mask = 'candidate'
-        return mask.sub(candidate_mask, self.get_sentence())
+        if self._masked_sentence is None:
+            mask = re.compile(f'{re.escape(self.candidate_1)}|{re.escape(self.candidate_2)}')
+            candidate_mask = 'candidate'
+            object.__setattr__(self, '_masked_sentence', mask.sub(candidate_mask, self.get_sentence()))
+        return self._masked_sentence
 
     def get_correct_candidate(self):
         return self.candidate_1.lower() if self.answer == 1 else self.candidate_2.lower()